@@ -12,15 +12,33 @@ import streamlit as st
 import pandas as pd
 from datetime import date, timedelta, datetime
 import hashlib
+import hmac
 import plotly.express as px
 import plotly.graph_objects as go
 from io import BytesIO
 import gspread
-from gspread_dataframe import get_as_dataframe, set_with_dataframe
+from gspread.utils import absolute_range_name, rowcol_to_a1
+from gspread.http_client import HTTPClient
+from gspread.exceptions import APIError
+import requests
 from oauth2client.service_account import ServiceAccountCredentials
-from PIL import Image
+from PIL import Image, ImageOps, features
 import base64
 import os
+import threading
+import contextvars
+import sqlite3
+import json
+import time
+import uuid
+import random
+import csv
+import io
+import tempfile
+import zipfile
+from collections import deque, Counter, OrderedDict
+from contextlib import contextmanager, closing
+from dataclasses import dataclass, replace
 # from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, JsCode
 
 
@@ -40,9 +58,211 @@ st.set_page_config(
 SHEET_NAME = "kanban_backend"
 CREDENTIALS_FILE = "credenciales.json"  # si usas archivo local en lugar de st.secrets
 
+# Dominios de los campos categóricos (en el orden en que se muestran)
+TASK_STATUSES = ("Por hacer", "En proceso", "Hecho")
+TASK_PRIORITIES = ("Alta", "Media", "Baja")
+TASK_SHIFTS = ("1er Turno", "2do Turno", "3er Turno")
+EXTENSION_STATUSES = ("Pendiente", "Aprobada", "Rechazada")
+USER_ROLES = ("Admin Principal", "Supervisor", "Coordinador", "Colaborador")
+
+@dataclass(frozen=True)
+class Column:
+    """Tipo de una columna: text, int, float, date, datetime o category (con su dominio); default rellena vacíos"""
+    kind: str = "text"
+    domain: tuple = ()
+    default: object = None
+
+# Esquema de cada hoja (el orden de las columnas es el de los encabezados); se aplica una sola vez al leer
+WORKSHEET_SCHEMAS = {
+    "tasks": {
+        'id': Column("int"), 'task': Column(), 'description': Column(), 'date': Column("date"),
+        'priority': Column("category", TASK_PRIORITIES), 'shift': Column("category", TASK_SHIFTS),
+        'start_date': Column("date"), 'due_date': Column("date"),
+        'status': Column("category", TASK_STATUSES, default="Por hacer"), 'completion_date': Column("date"),
+        'progress': Column("int", default=0), 'created_by': Column(), 'document_links': Column(),
+    },
+    "task_collaborators": {'task_id': Column("int"), 'username': Column()},
+    "task_interactions": {
+        'id': Column("int"), 'task_id': Column("int"), 'username': Column(), 'action_type': Column(),
+        'timestamp': Column("datetime"), 'comment_text': Column(), 'image_base64': Column(),
+        'new_status': Column("category", TASK_STATUSES), 'progress_value': Column("int"),
+        'image_ref': Column(), 'thumbnail_ref': Column(),
+    },
+    "users": {'username': Column(), 'password_hash': Column(), 'role': Column("category", USER_ROLES)},
+    "task_items": {
+        'id': Column("int"), 'task_id': Column("int"), 'item_name': Column(),
+        'status': Column("category", TASK_STATUSES, default="Por hacer"), 'progress': Column("int", default=0),
+        'completion_date': Column("date"),
+    },
+    "plant_machines": {
+        'machine_id': Column(), 'machine_name': Column(), 'area': Column(), 'coord_x': Column("float"),
+        'coord_y': Column("float"), 'machine_type': Column(), 'status': Column(),
+        'last_maintenance': Column("date"), 'next_maintenance': Column("date"),
+    },
+    "time_extension_requests": {
+        'id': Column("int"), 'task_id': Column("int"), 'username': Column(), 'request_date': Column("date"),
+        'current_due_date': Column("date"), 'requested_due_date': Column("date"), 'reason': Column(),
+        'status': Column("category", EXTENSION_STATUSES), 'approved_by': Column(), 'decision_date': Column("date"),
+    },
+    "id_counters": {'worksheet': Column(), 'next_id': Column("int"), 'claim': Column()},
+}
+
+# Hojas que forman el tablero; se leen juntas en una sola llamada batch
+BOARD_WORKSHEETS = ["tasks", "task_collaborators", "task_interactions", "task_items", "time_extension_requests"]
+
+# Archivo (datos fríos): tareas en "Hecho" con más de ARCHIVE_AFTER_DAYS días salen de las hojas activas
+# y pasan, con sus registros relacionados, a hojas archive_* con los mismos encabezados
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_WORKSHEETS = {name: f"archive_{name}" for name in BOARD_WORKSHEETS}
+WORKSHEET_SCHEMAS.update({archive: WORKSHEET_SCHEMAS[name] for name, archive in ARCHIVE_WORKSHEETS.items()})
+
+# Encabezados de cada hoja
+WORKSHEET_COLUMNS = {name: list(schema) for name, schema in WORKSHEET_SCHEMAS.items()}
+
+# Límites del cliente de Sheets (cuota por minuto, ráfaga permitida y reintentos ante 429/5xx)
+SHEETS_REQUESTS_PER_MINUTE = 60
+SHEETS_BURST = 10
+SHEETS_MAX_RETRIES = 5
+SHEETS_BACKOFF_MAX_SECONDS = 32
+
+# Versión del esquema de hojas; al incrementarla el bootstrap se repite en el siguiente arranque
+SCHEMA_VERSION = 6
+
+# Cantidad de ids que cada proceso reserva de una vez en la hoja id_counters e intentos ante reservas simultáneas
+ID_BLOCK_SIZE = 20
+ID_RESERVE_ATTEMPTS = 5
+
+# Modo write-behind (opcional): las escrituras van a una cola local y un hilo las envía a Sheets
+WRITE_BEHIND_QUEUE_PATH = "kanban_write_queue.db"
+WRITE_BEHIND_FLUSH_SECONDS = 2
+
+# Almacenamiento de los datos: "sheets" (Google Sheets), "sqlite" (archivo local, sin conexión)
+# u "offline" (réplica SQLite local sincronizada con Sheets en segundo plano).
+# Se elige con storage en st.secrets o la variable de entorno STORAGE (la ruta del archivo con sqlite_path / SQLITE_PATH).
+# Al pasar a "sqlite", la primera vez que la base está vacía se copian todas las hojas de Google Sheets
+# (si hay credenciales configuradas). Si tampoco así hay usuarios, la pantalla de acceso ofrece crear el administrador
+# inicial solo si hay una clave admin_setup_token configurada (st.secrets o ADMIN_SETUP_TOKEN), que debe ingresarse en el formulario.
+SQLITE_PATH = "kanban.db"
+SQLITE_TYPES = {"int": "INTEGER", "float": "REAL"}
+SQLITE_INDEXED_COLUMNS = ("id", "task_id", "status", "username")
+
+# Modo offline-first: segundos entre sincronizaciones e ids reservados de antemano por hoja para trabajar sin conexión
+OFFLINE_SYNC_SECONDS = 30
+OFFLINE_ID_STOCK = 100
+# Horas que el diario conserva las entradas ya enviadas o en conflicto antes de borrarlas
+OFFLINE_JOURNAL_KEEP_HOURS = 24
+
+# Almacén de imágenes de evidencia (blob_store): sin configurar ("inline") la imagen se guarda en base64 dentro de la hoja,
+# con tamaño INLINE_IMAGE_SIZE; "gdrive" (carpeta de una unidad compartida) o "local" (directorio BLOB_DIR, solo si el disco
+# es persistente: en un contenedor se pierde al reiniciar y la hoja queda con referencias a imágenes que ya no existen)
+BLOB_DIR = "evidence_blobs"
+INLINE_IMAGE_SIZE = (800, 600)
+
+# Procesamiento de evidencias: límites de entrada y tamaño/calidad de la versión completa
+IMAGE_MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+IMAGE_MAX_PIXELS = 50_000_000
+IMAGE_FULL_SIZE = (1600, 1600)
+IMAGE_QUALITY = 80
+
+# Exportación: hojas incluidas (con su nombre en el archivo), filas leídas por solicitud y columnas omitidas
+EXPORT_SHEETS = [("tasks", "Tareas"), ("task_collaborators", "Colaboradores"), ("task_interactions", "Interacciones"),
+                 ("task_items", "Items"), ("time_extension_requests", "Extensiones")]
+EXPORT_CHUNK_ROWS = 2000
+EXPORT_OMITTED_COLUMNS = {"image_base64"}
+
+# Historial de interacciones: entradas por página y tamaño de las miniaturas de evidencia
+HISTORY_PAGE_SIZE = 5
+THUMBNAIL_SIZE = (160, 160)
+
+# Columnas del tablero: tarjetas por página (elegible por usuario) y orden inicial
+KANBAN_PAGE_SIZES = (10, 20, 50)
+KANBAN_DEFAULT_SORT = "Vencimiento"
+
+# Tarjetas HTML memorizadas por proceso (las menos usadas se descartan al superar el límite)
+CARD_CACHE_SIZE = 2048
+
+# Segundos que el snapshot compartido del tablero se reutiliza antes de volver a leer Sheets
+SNAPSHOT_TTL_SECONDS = 60
+
 # ---------------------------
 # Conexión a Google Sheets
 # ---------------------------
+@st.cache_resource
+def get_sheets_quota():
+    """Estado compartido del límite de tasa y del conteo de solicitudes a Sheets (uno por proceso)"""
+    return {
+        "lock": threading.Lock(),
+        "tokens": float(SHEETS_BURST),
+        "refilled_at": time.monotonic(),
+        "recent": deque(),  # instantes de las solicitudes del último minuto
+        "total": 0,
+        "retries": 0,
+        "throttled": 0,
+    }
+
+def sheets_requests_last_minute():
+    quota = get_sheets_quota()
+    with quota["lock"]:
+        _prune_recent(quota, time.monotonic())
+        return len(quota["recent"])
+
+def _prune_recent(quota, now):
+    while quota["recent"] and now - quota["recent"][0] > 60:
+        quota["recent"].popleft()
+
+class QuotaAwareHTTPClient(HTTPClient):
+    """
+    Cliente HTTP de gspread con límite de tasa (token bucket de SHEETS_REQUESTS_PER_MINUTE),
+    reintentos con backoff exponencial y jitter ante 429/5xx o fallas de red, y conteo por minuto.
+    Los POST que no se pueden repetir sin efecto (agregar filas, borrar filas) solo se reintentan ante 429,
+    cuando Sheets rechazó la solicitud sin aplicarla.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    IDEMPOTENT_POSTS = ("values:batchUpdate", "values:batchGet", "values:batchGetByDataFilter", "values:batchClear", ":clear")
+
+    def __init__(self, auth, session=None):
+        super().__init__(auth, session)
+        self._quota = get_sheets_quota()
+
+    def _acquire(self):
+        quota = self._quota
+        rate = SHEETS_REQUESTS_PER_MINUTE / 60.0
+        while True:
+            with quota["lock"]:
+                now = time.monotonic()
+                quota["tokens"] = min(float(SHEETS_BURST), quota["tokens"] + (now - quota["refilled_at"]) * rate)
+                quota["refilled_at"] = now
+                if quota["tokens"] >= 1:
+                    quota["tokens"] -= 1
+                    _prune_recent(quota, now)
+                    quota["recent"].append(now)
+                    quota["total"] += 1
+                    return
+                wait = (1 - quota["tokens"]) / rate
+                quota["throttled"] += 1
+            time.sleep(wait)
+
+    def _idempotent(self, method, endpoint):
+        return method.upper() != "POST" or str(endpoint).endswith(self.IDEMPOTENT_POSTS)
+
+    def request(self, method, endpoint, *args, **kwargs):
+        idempotent = self._idempotent(method, endpoint)
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            self._acquire()
+            try:
+                return super().request(method, endpoint, *args, **kwargs)
+            except APIError as e:
+                retry_status = self.RETRY_STATUS if idempotent else (429,)
+                if e.code not in retry_status or attempt == SHEETS_MAX_RETRIES:
+                    raise
+            except requests.exceptions.RequestException:
+                # sin respuesta no se sabe si la escritura se aplicó
+                if not idempotent or attempt == SHEETS_MAX_RETRIES:
+                    raise
+            with self._quota["lock"]:
+                self._quota["retries"] += 1
+            time.sleep(random.uniform(0, min(SHEETS_BACKOFF_MAX_SECONDS, 2 ** attempt)))
+
 @st.cache_resource
 def get_gsheet_connection():
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
@@ -51,13 +271,13 @@ def get_gsheet_connection():
         if "gcp_service_account" in st.secrets:
             creds_dict = st.secrets["gcp_service_account"]
             creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            client = gspread.authorize(creds)
+            client = gspread.authorize(creds, http_client=QuotaAwareHTTPClient)
             return client.open(SHEET_NAME)
         else:
             # Si tienes archivo de credenciales local
             if os.path.exists(CREDENTIALS_FILE):
                 creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-                client = gspread.authorize(creds)
+                client = gspread.authorize(creds, http_client=QuotaAwareHTTPClient)
                 return client.open(SHEET_NAME)
             else:
                 raise Exception("No se encontraron credenciales: usar st.secrets['gcp_service_account'] o credenciales.json")
@@ -65,58 +285,91 @@ def get_gsheet_connection():
         st.error(f"Error en conexión Google Sheets: {e}")
         raise
 
+def get_setting(name, default=None):
+    """Valor de configuración desde st.secrets o, si no existe, desde la variable de entorno en mayúsculas"""
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+    except Exception:
+        pass
+    return os.environ.get(name.upper(), default)
+
+def storage_backend():
+    return str(get_setting("storage", "sheets")).strip().lower()
+
+def write_behind_enabled():
+    # la cola write-behind solo tiene sentido frente a la API de Sheets
+    return storage_backend() == "sheets" and str(get_setting("write_behind", "false")).strip().lower() in ("1", "true", "yes", "si", "sí")
+
 # ---------------------------
 # Funciones utilitarias y backend
 # ---------------------------
+@st.cache_resource
+def get_worksheet_handles():
+    """Handles de las hojas resueltos una sola vez por proceso (una sola llamada de metadatos)"""
+    return {ws.title: ws for ws in get_gsheet_connection().worksheets()}
+
+def get_worksheet(name):
+    """Handle cacheado de la hoja indicada"""
+    handles = get_worksheet_handles()
+    if name not in handles:
+        handles[name] = get_gsheet_connection().worksheet(name)
+    return handles[name]
+
 def ensure_worksheets_exist():
-    """Verifica y crea las hojas necesarias si no existen"""
-    try:
-        sheet = get_gsheet_connection()
-        required_sheets = ["tasks", "task_collaborators", "task_interactions", "users", "task_items", "plant_machines", "time_extension_requests"]
-        existing_sheets = [ws.title for ws in sheet.worksheets()]
-        for sheet_name in required_sheets:
-            if sheet_name not in existing_sheets:
-                new_worksheet = sheet.add_worksheet(title=sheet_name, rows=200, cols=20)
-                if sheet_name == "tasks":
-                    new_worksheet.update('A1', [['id', 'task', 'description', 'date', 'priority',
-                                                'shift', 'start_date', 'due_date', 'status',
-                                                'completion_date', 'progress', 'created_by', 'document_links']])
-                elif sheet_name == "task_collaborators":
-                    new_worksheet.update('A1', [['task_id', 'username']])
-                elif sheet_name == "task_interactions":
-                    new_worksheet.update('A1', [['id', 'task_id', 'username', 'action_type',
-                                                'timestamp', 'comment_text', 'image_base64', 'new_status', 'progress_value']])
-                elif sheet_name == "users":
-                    new_worksheet.update('A1', [['username', 'password_hash', 'role']])
-                elif sheet_name == "task_items":
-                    new_worksheet.update('A1', [['id', 'task_id', 'item_name', 'status', 'progress', 'completion_date']])
-                elif sheet_name == "plant_machines":
-                    new_worksheet.update('A1', [['machine_id', 'machine_name', 'area', 'coord_x', 'coord_y',
-                                                'machine_type', 'status', 'last_maintenance', 'next_maintenance']])
-                elif sheet_name == "time_extension_requests":
-                    new_worksheet.update('A1', [['id', 'task_id', 'username', 'request_date',
-                                                'current_due_date', 'requested_due_date', 'reason',
-                                                'status', 'approved_by', 'decision_date']])
-                st.success(f"Hoja '{sheet_name}' creada automáticamente")
-    except Exception as e:
-        st.error(f"Error al verificar hojas: {str(e)}")
+    """Verifica y crea las hojas necesarias si no existen y completa encabezados faltantes; devuelve {hoja: encabezado}"""
+    sheet = get_gsheet_connection()
+    handles = get_worksheet_handles()
+    headers = {}
+    existing = [name for name in WORKSHEET_COLUMNS if name in handles]
+    if existing:
+        response = sheet.values_batch_get([absolute_range_name(name, "1:1") for name in existing])
+        for name, value_range in zip(existing, response.get("valueRanges", [])):
+            values = value_range.get("values", [])
+            headers[name] = [str(h).strip() for h in values[0]] if values else []
+    for sheet_name, columns in WORKSHEET_COLUMNS.items():
+        if sheet_name not in handles:
+            new_worksheet = sheet.add_worksheet(title=sheet_name, rows=200, cols=max(20, len(columns)))
+            new_worksheet.update(values=[columns], range_name='A1')
+            handles[sheet_name] = new_worksheet
+            headers[sheet_name] = list(columns)
+            continue
+        header = headers.get(sheet_name, [])
+        missing = [col for col in columns if col not in header]
+        if missing:
+            ws = handles[sheet_name]
+            new_header = header + missing
+            if len(new_header) > ws.col_count:
+                ws.add_cols(len(new_header) - ws.col_count)
+            ws.update(values=[new_header], range_name='A1')
+            headers[sheet_name] = new_header
+    return headers
+
+@st.cache_resource(show_spinner=False)
+def bootstrap_schema(schema_version):
+    """Prepara hojas o tablas del almacenamiento una sola vez por versión de esquema y proceso; devuelve {hoja: encabezado}"""
+    return get_storage().ensure_schema()
+
+def worksheet_columns(ws_name):
+    """Encabezado real de la hoja según el bootstrap"""
+    return bootstrap_schema(SCHEMA_VERSION).get(ws_name) or WORKSHEET_COLUMNS[ws_name]
+
+def used_columns(ws_name):
+    """Letra de la última columna con encabezado; las lecturas no pasan de ahí"""
+    return rowcol_to_a1(1, len(worksheet_columns(ws_name)))[:-1]
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 def get_user_data(username):
     try:
-        sheet = get_gsheet_connection()
-        ws_users = sheet.worksheet("users")
-        df_users = get_as_dataframe(ws_users)
-        df_users = df_users.dropna(how='all')
+        df_users = read_worksheet("users")
         if df_users.empty:
             return None
-        df_users.columns = df_users.columns.str.strip().str.lower()
         mask = df_users['username'].str.strip().str.lower() == username.strip().lower()
         user_row = df_users[mask]
         if not user_row.empty:
-            return user_row.iloc[0].to_dict()
+            return {col: _model_value(value) for col, value in user_row.iloc[0].items()}
         return None
     except Exception as e:
         st.error(f"Error al cargar datos de usuario: {e}")
@@ -130,7 +383,7 @@ def login_user(username, password):
     if not user_data:
         st.error("Usuario no encontrado")
         return False
-    stored_hash = user_data.get('password_hash', '').strip()
+    stored_hash = (user_data.get('password_hash') or '').strip()
     if not stored_hash:
         st.error("Credenciales inválidas")
         return False
@@ -139,7 +392,7 @@ def login_user(username, password):
     if provided_hash == stored_hash:
         st.session_state.logged_in = True
         st.session_state.username = username
-        st.session_state.current_role = user_data.get('role', 'Colaborador').strip()
+        st.session_state.current_role = (user_data.get('role') or 'Colaborador').strip()
         st.success(f"Bienvenido, {username}!")
         return True
     st.error("Contraseña incorrecta")
@@ -148,283 +401,1608 @@ def login_user(username, password):
 # ---------------------------
 # Operaciones con tareas, items, interacciones
 # ---------------------------
-def load_tasks_from_db():
-    """Carga tareas, colaboradores, interacciones, items y extension requests; arma st.session_state.kanban y all_tasks_df"""
+def _typed_column(series, column):
+    """Convierte una columna al tipo declarado en el esquema"""
+    # NaN/NaT/NA -> None para que todas las conversiones partan de lo mismo
+    series = series.astype(object).where(series.notna(), None)
+    if column.kind in ("int", "float"):
+        series = pd.to_numeric(series, errors='coerce').astype("float64")
+        if column.default is not None:
+            series = series.fillna(column.default)
+        if column.kind == "float":
+            return series
+        return series.round().astype("int64" if column.default is not None else "Int64")
+    if column.kind in ("date", "datetime"):
+        return pd.to_datetime(series, errors='coerce', format="mixed")
+    series = series.where(series.isna(), series.astype(str))
+    if column.default is not None:
+        series = series.fillna(column.default)
+    if column.kind == "category":
+        observed = sorted(set(series.dropna()) - set(column.domain))
+        return pd.Series(pd.Categorical(series, categories=list(column.domain) + observed), index=series.index)
+    return series
+
+def apply_schema(df, ws_name):
+    """
+    Copia del DataFrame con las columnas convertidas a los tipos del esquema de la hoja (aplicarlo dos veces no cambia nada).
+    Las columnas que el esquema no conoce se conservan y las que faltan en la hoja se agregan vacías.
+    """
+    schema = WORKSHEET_SCHEMAS.get(ws_name, {})
+    typed = {}
+    for name in list(df.columns) + [name for name in schema if name not in df.columns]:
+        series = df[name] if name in df.columns else pd.Series(None, index=df.index, dtype=object)
+        typed[name] = _typed_column(series, schema[name]) if name in schema else series
+    return pd.DataFrame(typed, index=df.index)
+
+def empty_frame(ws_name):
+    """DataFrame vacío con las columnas y tipos de la hoja"""
+    return apply_schema(pd.DataFrame(), ws_name)
+
+def values_to_dataframe(values, ws_name):
+    """
+    Convierte los valores crudos de una hoja (encabezado + filas) en DataFrame tipado según su esquema.
+    El índice es el número de fila en la hoja; las filas sin valor en la primera columna se descartan.
+    """
+    if not values or not any(str(h).strip() for h in values[0]):
+        return empty_frame(ws_name)
+    header = [str(h).strip() for h in values[0]]
+    width = len(header)
+    rows = [list(r[:width]) + [None] * (width - len(r)) for r in values[1:]]
+    return _frame_from_rows(header, rows, pd.RangeIndex(2, len(rows) + 2), ws_name)
+
+def _frame_from_rows(header, rows, index, ws_name):
+    """DataFrame tipado a partir de filas alineadas al encabezado; descarta las filas sin valor en la primera columna"""
+    df = pd.DataFrame(rows, columns=header, index=index)
+    df = df.loc[:, [h != "" for h in header]]
+    df = df.mask(df.eq(""))
+    if not df.empty:
+        df = df[df.iloc[:, 0].notna()]
+    return apply_schema(df, ws_name)
+
+_READ_PARAMS = {
+    "valueRenderOption": "UNFORMATTED_VALUE",
+    "dateTimeRenderOption": "FORMATTED_STRING",
+}
+
+def read_worksheet(ws_name):
+    """Lee una hoja completa del almacenamiento, tipada según su esquema"""
+    return get_storage().read_frames([ws_name])[ws_name]
+
+def fetch_worksheets_batch(names):
+    """Lee varias hojas juntas (en Sheets, con una sola llamada values_batch_get); devuelve {nombre: DataFrame}"""
+    return get_storage().read_frames(names)
+
+def _cell_value(value):
+    """Normaliza un valor para la API de Sheets (sin NaN/NA, fechas como texto y sin escalares de numpy)"""
+    if value is None or value is pd.NaT or value is pd.NA:
+        return ""
+    if isinstance(value, datetime):
+        if value.hour == value.minute == value.second == 0:
+            return value.strftime("%Y-%m-%d")
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return ""
+    return value
+
+def append_records(ws_name, records):
+    """Agrega registros al final de la hoja con append_rows; el costo no depende del tamaño de la hoja"""
+    if not records:
+        return
+    transaction = _active_transaction.get()
+    if transaction is not None:
+        transaction.append(ws_name, records)
+        return
+    dispatch_writes({ws_name: list(records)}, {})
+
+def _as_record_id(value):
+    """Convierte un id leído de la hoja a int (None si no es numérico)"""
     try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def build_row_index(frames):
+    """Índice {hoja: {id: número de fila}} para las hojas con columna id"""
+    index = {}
+    for name, df in frames.items():
+        if df.empty or 'id' not in df.columns:
+            continue
+        ids = df['id']
+        valid = ids.notna()
+        index[name] = dict(zip(ids[valid].astype(int).tolist(), df.index[valid].tolist()))
+    return index
+
+def find_record_row(ws_name, record_id):
+    """Fila del registro según el índice de la última carga; si no aparece, se busca solo en la columna de ids"""
+    record_id = int(record_id)
+    row = st.session_state.get('row_index', {}).get(ws_name, {}).get(record_id)
+    if row is None:
+        row = get_storage().find_row(ws_name, record_id)
+    return row
+
+def update_record_cells(ws_name, record_id, changes):
+    """Escribe solo las celdas indicadas de un registro con un batch_update; devuelve False si no existe"""
+    if not changes:
+        return True
+    transaction = _active_transaction.get()
+    if transaction is not None and transaction.has_pending_append(ws_name, record_id):
+        transaction.update(ws_name, record_id, changes)
+        return True
+    queued = write_behind_enabled() and get_write_behind_queue().has_pending_record(ws_name, record_id)
+    if not queued and find_record_row(ws_name, record_id) is None:
+        return False
+    if transaction is not None:
+        transaction.update(ws_name, record_id, changes)
+        return True
+    dispatch_writes({}, {ws_name: {int(record_id): dict(changes)}})
+    return True
+
+def dispatch_writes(appends, updates):
+    """
+    Envía altas ({hoja: [registros]}) y cambios ({hoja: {id: {columna: valor}}}) al almacenamiento
+    en una sola escritura. En modo write-behind se encolan localmente y el hilo de fondo los envía.
+    """
+    if write_behind_enabled():
+        get_write_behind_queue().enqueue(appends, updates)
+        return
+    get_storage().write(appends, updates)
+    if (set(updates) | set(appends)) & set(BOARD_WORKSHEETS):
+        invalidate_board_snapshot()
+
+def _cell_update_ranges(ws_name, row, changes):
+    columns = worksheet_columns(ws_name)
+    return [{"range": absolute_range_name(ws_name, rowcol_to_a1(row, columns.index(col) + 1)),
+             "values": [[_cell_value(value)]]}
+            for col, value in changes.items()]
+
+# ---------------------------
+# Almacenamiento (Google Sheets o SQLite local)
+# ---------------------------
+# Ambos backends exponen las mismas operaciones; las filas se identifican por el índice de los DataFrames
+# que devuelven (número de fila en Sheets, rowid en SQLite)
+class SheetsStorage:
+    """Datos en la hoja de cálculo de Google (una hoja por tabla, encabezados en la fila 1)"""
+
+    def ensure_schema(self):
+        return ensure_worksheets_exist()
+
+    def read_frames(self, names):
+        # solo las columnas del encabezado; la API ya omite las filas vacías del final
+        ranges = [absolute_range_name(name, f"A:{used_columns(name)}") for name in names]
+        response = get_gsheet_connection().values_batch_get(ranges, params=_READ_PARAMS)
+        value_ranges = response.get("valueRanges", [])
+        frames = {}
+        for i, name in enumerate(names):
+            values = value_ranges[i].get("values", []) if i < len(value_ranges) else []
+            frames[name] = values_to_dataframe(values, name)
+        return frames
+
+    def find_row(self, ws_name, record_id):
+        # solo la columna de ids, no la hoja completa
+        ids = get_worksheet(ws_name).col_values(1, value_render_option="UNFORMATTED_VALUE")
+        for row_number, value in enumerate(ids[1:], start=2):
+            if _as_record_id(value) == record_id:
+                return row_number
+        return None
+
+    def get_record(self, ws_name, record_id):
+        row = find_record_row(ws_name, record_id)
+        if row is None:
+            return None
+        columns = worksheet_columns(ws_name)
+        values = get_worksheet(ws_name).row_values(row, value_render_option="UNFORMATTED_VALUE",
+                                                   date_time_render_option="FORMATTED_STRING")
+        return dict(zip(columns, values + [None] * (len(columns) - len(values))))
+
+    def _verified_rows(self, targets):
+        """
+        {(hoja, id): fila} con las filas del índice cacheado confirmadas leyendo solo su celda de id (una llamada).
+        Si otro proceso desplazó las filas (p. ej. al archivar), el registro se vuelve a ubicar en la columna de ids.
+        """
+        if not targets:
+            return {}
+        keys = list(targets)
+        ranges = [absolute_range_name(ws_name, f"A{targets[(ws_name, record_id)]}") for ws_name, record_id in keys]
+        response = get_gsheet_connection().values_batch_get(ranges, params={"valueRenderOption": "UNFORMATTED_VALUE"})
+        value_ranges = response.get("valueRanges", [])
+        rows, moved = {}, False
+        for i, (ws_name, record_id) in enumerate(keys):
+            values = value_ranges[i].get("values", []) if i < len(value_ranges) else []
+            if values and values[0] and _as_record_id(values[0][0]) == record_id:
+                rows[(ws_name, record_id)] = targets[(ws_name, record_id)]
+            else:
+                rows[(ws_name, record_id)] = self.find_row(ws_name, record_id)
+                moved = True
+        if moved:
+            # el índice de filas de este proceso quedó viejo
+            invalidate_board_snapshot()
+        return rows
+
+    def write(self, appends, updates):
+        # un solo values_batch_update para todas las celdas y un append_rows por hoja
+        targets = {}
+        for ws_name, records in updates.items():
+            for record_id in records:
+                row = find_record_row(ws_name, record_id)
+                if row is not None:
+                    targets[(ws_name, int(record_id))] = row
+        rows = self._verified_rows(targets)
+        data = []
+        for ws_name, records in updates.items():
+            for record_id, changes in records.items():
+                row = rows.get((ws_name, int(record_id)))
+                if row is not None:
+                    data.extend(_cell_update_ranges(ws_name, row, changes))
+        if data:
+            get_gsheet_connection().values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+        for ws_name, records in appends.items():
+            if records:
+                columns = worksheet_columns(ws_name)
+                rows = [[_cell_value(record.get(col)) for col in columns] for record in records]
+                get_worksheet(ws_name).append_rows(rows, value_input_option="USER_ENTERED", table_range="A1")
+
+    def update_rows(self, ws_name, changes_by_row):
+        data = []
+        for row, changes in changes_by_row.items():
+            data.extend(_cell_update_ranges(ws_name, row, changes))
+        if data:
+            get_gsheet_connection().values_batch_update({"valueInputOption": "RAW", "data": data})
+
+    def delete_rows(self, rows_by_sheet):
+        # todas las eliminaciones en una sola solicitud, de abajo hacia arriba para no desplazar filas pendientes
+        requests_body = []
+        for ws_name, rows in rows_by_sheet.items():
+            sheet_id = get_worksheet(ws_name).id
+            requests_body.extend({"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS",
+                                                                "startIndex": start - 1, "endIndex": end}}}
+                                 for start, end in _row_ranges(rows))
+        if requests_body:
+            get_gsheet_connection().batch_update({"requests": requests_body})
+
+    def reserve_ids(self, ws_name, size, floor):
+        return _reserve_sheet_ids(get_worksheet("id_counters"), ws_name, size, floor)
+
+    def clear(self, names):
+        for ws_name in names:
+            ws = get_worksheet(ws_name)
+            ws.clear()
+            # volver a crear encabezados
+            ws.update('A1', [WORKSHEET_COLUMNS[ws_name]])
+
+    def iter_chunks(self, ws_name, header, keep, chunk_rows):
         sheet = get_gsheet_connection()
-        ws_tasks = sheet.worksheet("tasks")
-        ws_collab = sheet.worksheet("task_collaborators")
-        ws_inter = sheet.worksheet("task_interactions")
-        ws_items = sheet.worksheet("task_items")
-        ws_extension = sheet.worksheet("time_extension_requests")
-
-        df_tasks_raw = get_as_dataframe(ws_tasks)
-        df_collab_raw = get_as_dataframe(ws_collab)
-        df_inter_raw = get_as_dataframe(ws_inter)
-        df_items_raw = get_as_dataframe(ws_items)
-        df_extension_raw = get_as_dataframe(ws_extension)
-
-        df_tasks = df_tasks_raw[df_tasks_raw.iloc[:, 0].notna()].copy() if not df_tasks_raw.empty else pd.DataFrame(columns=['id', 'task', 'description', 'date', 'priority', 'shift', 'start_date', 'due_date', 'status', 'completion_date', 'progress', 'created_by', 'document_links'])
-        df_collab = df_collab_raw[df_collab_raw.iloc[:, 0].notna()].copy() if not df_collab_raw.empty else pd.DataFrame(columns=['task_id', 'username'])
-        df_inter = df_inter_raw[df_inter_raw.iloc[:, 0].notna()].copy() if not df_inter_raw.empty else pd.DataFrame(columns=['id', 'task_id', 'username', 'action_type', 'timestamp', 'comment_text', 'image_base64', 'new_status', 'progress_value'])
-        df_items = df_items_raw[df_items_raw.iloc[:, 0].notna()].copy() if not df_items_raw.empty else pd.DataFrame(columns=['id', 'task_id', 'item_name', 'status', 'progress', 'completion_date'])
-        df_extension = df_extension_raw[df_extension_raw.iloc[:, 0].notna()].copy() if not df_extension_raw.empty else pd.DataFrame(columns=['id', 'task_id', 'username', 'request_date', 'current_due_date', 'requested_due_date', 'reason', 'status', 'approved_by', 'decision_date'])
-
-        kanban_data = {"Por hacer": [], "En proceso": [], "Hecho": []}
-        all_tasks_list = []
-
-        if not df_tasks.empty:
-            # Asegurar tipos
-            df_tasks['id'] = pd.to_numeric(df_tasks['id'], errors='coerce').fillna(0).astype(int)
-            if not df_collab.empty and 'task_id' in df_collab.columns:
-                df_collab['task_id'] = pd.to_numeric(df_collab['task_id'], errors='coerce').fillna(-1).astype(int)
-            if not df_inter.empty and 'task_id' in df_inter.columns:
-                df_inter['task_id'] = pd.to_numeric(df_inter['task_id'], errors='coerce').fillna(-1).astype(int)
-            if not df_items.empty and 'task_id' in df_items.columns:
-                df_items['task_id'] = pd.to_numeric(df_items['task_id'], errors='coerce').fillna(-1).astype(int)
-            if not df_extension.empty and 'task_id' in df_extension.columns:
-                df_extension['task_id'] = pd.to_numeric(df_extension['task_id'], errors='coerce').fillna(-1).astype(int)
-
-            for _, row in df_tasks.iterrows():
-                task = row.to_dict()
-                task_id = int(task['id'])
-                responsables = []
-                if not df_collab.empty:
-                    # Filtra solo las filas para el task_id y extrae la columna 'username'
-                    responsables_raw = df_collab[df_collab['task_id']==task_id]['username'].tolist()
-                    responsables = [str(r).strip() for r in responsables_raw if pd.notna(r) and str(r).strip()]
-
-                task['responsible_list'] = responsables
-                task['responsible'] = ", ".join(responsables)
-                interacciones = []
-                if not df_inter.empty:
-                    interacciones = df_inter[df_inter['task_id']==task_id].to_dict('records')
-                task['interactions'] = interacciones
-
-                # attach items summary
-                items_for_task = []
-                if not df_items.empty:
-                    items_for_task = df_items[df_items['task_id']==task_id].to_dict('records')
-                task['items'] = items_for_task
-
-                # attach extension requests summary
-                extension_requests = []
-                if not df_extension.empty:
-                    extension_requests = df_extension[df_extension['task_id']==task_id].to_dict('records')
-                task['extension_requests'] = extension_requests
-                task['extension_count'] = len(extension_requests)
-
-                status_val = task.get('status') or "Por hacer"
-                if status_val in kanban_data:
-                    kanban_data[status_val].append(task)
+        last_col = used_columns(ws_name)
+        start = 2
+        while True:
+            end = start + chunk_rows - 1
+            response = sheet.values_get(absolute_range_name(ws_name, f"A{start}:{last_col}{end}"), params=_READ_PARAMS)
+            values = response.get("values", [])
+            rows = []
+            for row in values:
+                row = list(row) + [None] * (len(header) - len(row))
+                if row[0] not in (None, ""):
+                    rows.append([row[i] if row[i] != "" else None for i in keep])
+            if rows:
+                yield rows
+            if len(values) < chunk_rows:
+                return
+            start = end + 1
+
+def _reserved_until(rows, ws_name):
+    """Primer id libre de la hoja según las filas de id_counters (cada fila guarda el fin de una reserva)"""
+    ends = [_as_record_id(values[1]) for values in rows if len(values) > 1 and values[0].strip() == ws_name]
+    return max([end for end in ends if end is not None], default=1)
+
+def _reserve_sheet_ids(counters, ws_name, size, floor):
+    """
+    Reserva size ids de la hoja en id_counters (handle counters), nunca por debajo de floor; devuelve (inicio, fin).
+    Cada reserva agrega una fila [hoja, fin, marca] y vuelve a leer la hoja: el bloque es propio solo si ninguna
+    fila anterior reserva ids desde su inicio, así que dos procesos que leyeron el mismo contador no comparten ids
+    (el que llegó segundo reintenta a partir del bloque del primero).
+    """
+    for _ in range(ID_RESERVE_ATTEMPTS):
+        claim = uuid.uuid4().hex
+        start = max(_reserved_until(counters.get_all_values()[1:], ws_name), floor)
+        end = start + size
+        counters.append_rows([[ws_name, end, claim]], value_input_option="RAW", table_range="A1")
+        rows = counters.get_all_values()[1:]
+        position = next((i for i, values in enumerate(rows) if len(values) > 2 and values[2] == claim), None)
+        if position is not None and _reserved_until(rows[:position], ws_name) <= start:
+            return start, end
+    raise RuntimeError(f"No se pudo reservar un bloque de ids para {ws_name}")
+
+def _sqlite_value(value):
+    """Valor para SQLite: mismo formato que en Sheets, con NULL en lugar de celdas vacías"""
+    value = _cell_value(value)
+    return None if value == "" else value
+
+def _quoted(names):
+    return ", ".join(f'"{name}"' for name in names)
+
+class SQLiteStorage:
+    """
+    Datos en un archivo SQLite local (modo WAL): una tabla por hoja con sus mismas columnas,
+    índices en id, task_id, status y username. Permite usar la app sin conexión a Google.
+    """
+    def __init__(self, path):
+        self._path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30)
+
+    def is_empty(self):
+        """True si ninguna tabla tiene filas (base recién creada)"""
+        with closing(self._connect()) as conn:
+            return all(conn.execute(f'SELECT 1 FROM "{name}" LIMIT 1').fetchone() is None for name in WORKSHEET_SCHEMAS)
+
+    def ensure_schema(self):
+        headers = {}
+        with closing(self._connect()) as conn, conn:
+            for name, schema in WORKSHEET_SCHEMAS.items():
+                existing = [info[1] for info in conn.execute(f'PRAGMA table_info("{name}")')]
+                definitions = [f'"{col}" {SQLITE_TYPES.get(column.kind, "TEXT")}' for col, column in schema.items()
+                               if col not in existing]
+                if not existing:
+                    conn.execute(f'CREATE TABLE "{name}" ({", ".join(definitions)})')
                 else:
-                    kanban_data["Por hacer"].append(task)
-                all_tasks_list.append(task)
+                    for definition in definitions:
+                        conn.execute(f'ALTER TABLE "{name}" ADD COLUMN {definition}')
+                for col in SQLITE_INDEXED_COLUMNS:
+                    if col in schema:
+                        conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{name}_{col}" ON "{name}"("{col}")')
+                headers[name] = existing + [col for col in schema if col not in existing]
+        return headers
+
+    def read_frames(self, names):
+        columns = {name: worksheet_columns(name) for name in names}
+        frames = {}
+        with closing(self._connect()) as conn:
+            for name in names:
+                rows = conn.execute(f'SELECT rowid, {_quoted(columns[name])} FROM "{name}" ORDER BY rowid').fetchall()
+                index = pd.Index([row[0] for row in rows], dtype="int64")
+                frames[name] = _frame_from_rows(columns[name], [row[1:] for row in rows], index, name)
+        return frames
+
+    def find_row(self, ws_name, record_id):
+        with closing(self._connect()) as conn:
+            found = conn.execute(f'SELECT rowid FROM "{ws_name}" WHERE id = ?', (int(record_id),)).fetchone()
+        return found[0] if found else None
+
+    def get_record(self, ws_name, record_id):
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(f'SELECT * FROM "{ws_name}" WHERE id = ?', (int(record_id),))
+            found = cursor.fetchone()
+            return dict(zip([d[0] for d in cursor.description], found)) if found else None
+
+    def write(self, appends, updates):
+        # todo en una sola transacción
+        columns = {ws_name: worksheet_columns(ws_name) for ws_name, records in appends.items() if records}
+        with closing(self._connect()) as conn, conn:
+            for ws_name, records in updates.items():
+                for record_id, changes in records.items():
+                    if changes:
+                        assignments = ", ".join(f'"{col}" = ?' for col in changes)
+                        conn.execute(f'UPDATE "{ws_name}" SET {assignments} WHERE id = ?',
+                                     [_sqlite_value(v) for v in changes.values()] + [int(record_id)])
+            for ws_name, cols in columns.items():
+                placeholders = ", ".join("?" * len(cols))
+                conn.executemany(f'INSERT INTO "{ws_name}" ({_quoted(cols)}) VALUES ({placeholders})',
+                                 [[_sqlite_value(record.get(col)) for col in cols] for record in appends[ws_name]])
+
+    def update_rows(self, ws_name, changes_by_row):
+        with closing(self._connect()) as conn, conn:
+            for row, changes in changes_by_row.items():
+                assignments = ", ".join(f'"{col}" = ?' for col in changes)
+                conn.execute(f'UPDATE "{ws_name}" SET {assignments} WHERE rowid = ?',
+                             [_sqlite_value(v) for v in changes.values()] + [int(row)])
+
+    def delete_rows(self, rows_by_sheet):
+        with closing(self._connect()) as conn, conn:
+            for ws_name, rows in rows_by_sheet.items():
+                conn.executemany(f'DELETE FROM "{ws_name}" WHERE rowid = ?', [(int(row),) for row in rows])
+
+    def reserve_ids(self, ws_name, size, floor):
+        # BEGIN IMMEDIATE: otro proceso sobre el mismo archivo espera a que el contador quede actualizado
+        with closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            counter = conn.execute("SELECT next_id FROM id_counters WHERE worksheet = ?", (ws_name,)).fetchone()
+            max_id = conn.execute(f'SELECT MAX(id) FROM "{ws_name}"').fetchone()[0]
+            start = max((counter[0] if counter else None) or 1, floor, (max_id or 0) + 1)
+            end = start + size
+            if counter is None:
+                conn.execute("INSERT INTO id_counters (worksheet, next_id) VALUES (?, ?)", (ws_name, end))
+            else:
+                conn.execute("UPDATE id_counters SET next_id = ? WHERE worksheet = ?", (end, ws_name))
+        return start, end
+
+    def clear(self, names):
+        with closing(self._connect()) as conn, conn:
+            for ws_name in names:
+                conn.execute(f'DELETE FROM "{ws_name}"')
+
+    def iter_chunks(self, ws_name, header, keep, chunk_rows):
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(f'SELECT {_quoted(header[i] for i in keep)} FROM "{ws_name}" ORDER BY rowid')
+            while chunk := cursor.fetchmany(chunk_rows):
+                rows = [list(row) for row in chunk if row[0] is not None]
+                if rows:
+                    yield rows
+
+STORAGE_BACKENDS = {
+    "sheets": SheetsStorage,
+    "sqlite": lambda: SQLiteStorage(get_setting("sqlite_path", SQLITE_PATH)),
+    "offline": lambda: OfflineFirstStorage(get_setting("sqlite_path", SQLITE_PATH), get_offline_sync()),
+}
+
+@st.cache_resource
+def get_storage():
+    """Backend de almacenamiento configurado (storage = "sheets", "sqlite" u "offline")"""
+    backend = storage_backend()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Backend de almacenamiento desconocido: {backend}")
+    return STORAGE_BACKENDS[backend]()
+
+def import_sheets_into_storage(storage):
+    """
+    Copia todas las hojas de Google Sheets al almacenamiento indicado (usuarios, tablero, historial y archivo);
+    los contadores de ids se importan como una fila por hoja con el primer id libre. Devuelve cuántas filas copió.
+    """
+    names = [name for name in WORKSHEET_COLUMNS if name != "id_counters"]
+    frames = SheetsStorage().read_frames(names)
+    appends = {name: df.to_dict('records') for name, df in frames.items() if not df.empty}
+    counters = get_worksheet("id_counters").get_all_values()[1:]
+    appends["id_counters"] = [{"worksheet": name, "next_id": _reserved_until(counters, name)}
+                              for name in sorted({values[0].strip() for values in counters if values and values[0].strip()})]
+    storage.write(appends, {})
+    return sum(len(records) for records in appends.values())
+
+@st.cache_resource(show_spinner=False)
+def seed_local_storage(schema_version):
+    """
+    Con storage = "sqlite" y la base vacía, importa una sola vez los datos de Google Sheets.
+    Devuelve (filas importadas, error o None).
+    """
+    storage = get_storage()
+    if storage_backend() != "sqlite" or not storage.is_empty():
+        return 0, None
+    try:
+        return import_sheets_into_storage(storage), None
+    except Exception as e:
+        return 0, str(e)
+
+def has_users():
+    """
+    False solo si la hoja de usuarios se leyó y está vacía (ante un error se muestra el acceso normal).
+    En modo offline la réplica no cuenta como vacía hasta la primera sincronización completa.
+    """
+    if storage_backend() == "offline" and get_offline_sync().last_sync is None:
+        return True
+    try:
+        return not read_worksheet("users").empty
+    except Exception:
+        return True
+
+def first_admin_setup_allowed():
+    """
+    El formulario de administrador inicial solo se ofrece con storage = "sqlite" (ya intentada la importación
+    desde Sheets), una clave admin_setup_token configurada y ningún usuario registrado.
+    """
+    if storage_backend() != "sqlite" or not str(get_setting("admin_setup_token", "")).strip():
+        return False
+    return not has_users()
+
+def valid_admin_setup_token(token):
+    return hmac.compare_digest(str(token).encode(), str(get_setting("admin_setup_token", "")).strip().encode())
+
+# ---------------------------
+# Unidad de trabajo (agrupa las escrituras de una acción)
+# ---------------------------
+_active_transaction = contextvars.ContextVar("board_transaction", default=None)
+
+class BoardTransaction:
+    """Acumula altas y cambios de celdas; commit() los envía en lote (un append por hoja y un solo batch de celdas)"""
+    def __init__(self):
+        self.appends = {}
+        self.updates = {}
+
+    def append(self, ws_name, records):
+        self.appends.setdefault(ws_name, []).extend(dict(record) for record in records)
+
+    def has_pending_append(self, ws_name, record_id):
+        return any(_as_record_id(r.get('id')) == int(record_id) for r in self.appends.get(ws_name, []))
+
+    def update(self, ws_name, record_id, changes):
+        record_id = int(record_id)
+        for record in self.appends.get(ws_name, []):
+            if _as_record_id(record.get('id')) == record_id:
+                record.update(changes)
+                return
+        self.updates.setdefault(ws_name, {}).setdefault(record_id, {}).update(changes)
+
+    def pending_records(self, ws_name):
+        """Registros nuevos de la hoja que aún no se enviaron"""
+        return list(self.appends.get(ws_name, []))
+
+    def pending_changes(self, ws_name, record_id):
+        """Cambios de celdas pendientes para un registro existente"""
+        return dict(self.updates.get(ws_name, {}).get(int(record_id), {}))
+
+    def commit(self):
+        dispatch_writes(self.appends, self.updates)
+
+@contextmanager
+def board_transaction(reload=True):
+    """
+    Agrupa las escrituras de una acción del usuario. Dentro del bloque no se escribe en Sheets
+    ni se recarga el tablero; al salir se envía todo en lote y se recarga una sola vez
+    (reload=False deja la recarga para la siguiente ejecución completa).
+    Un bloque anidado se une a la transacción exterior.
+    """
+    current = _active_transaction.get()
+    if current is not None:
+        yield current
+        return
+    transaction = BoardTransaction()
+    token = _active_transaction.set(transaction)
+    try:
+        yield transaction
+    finally:
+        _active_transaction.reset(token)
+    transaction.commit()
+    if reload:
+        load_tasks_from_db()
+
+# -------------------------
+# Modelo de tareas
+# -------------------------
+@dataclass(frozen=True, slots=True)
+class TaskItem:
+    id: int
+    task_id: int
+    item_name: str | None
+    status: str | None
+    progress: int
+    completion_date: date | None
+
+@dataclass(frozen=True, slots=True)
+class Interaction:
+    id: int
+    task_id: int
+    username: str | None
+    action_type: str | None
+    timestamp: datetime | None
+    comment_text: str | None
+    image_base64: str | None
+    new_status: str | None
+    progress_value: int | None
+    image_ref: str | None
+    thumbnail_ref: str | None
+
+@dataclass(frozen=True, slots=True)
+class ExtensionRequest:
+    id: int
+    task_id: int
+    username: str | None
+    request_date: date | None
+    current_due_date: date | None
+    requested_due_date: date | None
+    reason: str | None
+    status: str | None
+    approved_by: str | None
+    decision_date: date | None
+
+@dataclass(frozen=True, slots=True)
+class Task:
+    """Tarea del tablero con sus registros relacionados; la comparten Kanban, Estadísticas y exportaciones"""
+    id: int
+    task: str | None
+    description: str | None
+    date: date | None
+    priority: str | None
+    shift: str | None
+    start_date: date | None
+    due_date: date | None
+    status: str
+    completion_date: date | None
+    progress: int
+    created_by: str | None
+    document_links: str | None
+    responsible_list: tuple = ()
+    interactions: tuple = ()
+    items: tuple = ()
+    extension_requests: tuple = ()
+
+    @property
+    def responsible(self):
+        return ", ".join(self.responsible_list)
+
+    @property
+    def extension_count(self):
+        return len(self.extension_requests)
+
+def _model_value(value, kind="text"):
+    """Valor de un DataFrame tipado como valor nativo del modelo (None en lugar de NaN/NaT/NA)"""
+    if value is None or value is pd.NaT or value is pd.NA:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.date() if kind == "date" else value.to_pydatetime()
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
 
-        st.session_state.kanban = kanban_data
-        st.session_state.all_tasks_df = pd.DataFrame(all_tasks_list)
+def _as_int(value, default=0):
+    if value is None:
+        return default
+    number = pd.to_numeric(value, errors='coerce')
+    return default if pd.isna(number) else int(number)
+
+def records_by_task(df, ws_name, model):
+    """Agrupa los registros de una hoja hija (ya tipada) por task_id en una sola pasada: {task_id: (instancias de model)}"""
+    if df.empty:
+        return {}
+    schema = WORKSHEET_SCHEMAS[ws_name]
+    names = model.__slots__
+    grouped = {}
+    for record in df[list(names)].to_dict('records'):
+        values = {name: _model_value(record[name], schema[name].kind) for name in names}
+        grouped.setdefault(values['task_id'], []).append(model(**values))
+    return {task_id: tuple(records) for task_id, records in grouped.items()}
+
+def build_board(frames):
+    """Arma el tablero (tareas por estado) y el DataFrame tipado de tareas a partir de las hojas leídas, sin modificarlas"""
+    kanban_data = {status: [] for status in TASK_STATUSES}
+
+    # una pasada por cada hoja hija en lugar de filtrar cada hoja por cada tarea
+    collaborators = frames["task_collaborators"]
+    responsibles_by_task = {}
+    for task_id, username in zip(collaborators['task_id'].tolist(), collaborators['username'].tolist()):
+        if pd.notna(task_id) and pd.notna(username) and username.strip():
+            responsibles_by_task.setdefault(int(task_id), []).append(username.strip())
+    inter_by_task = records_by_task(frames["task_interactions"], "task_interactions", Interaction)
+    items_by_task = records_by_task(frames["task_items"], "task_items", TaskItem)
+    extension_by_task = records_by_task(frames["time_extension_requests"], "time_extension_requests", ExtensionRequest)
+
+    schema = WORKSHEET_SCHEMAS["tasks"]
+    tasks_df = frames["tasks"][list(schema)]
+    responsible_lists = []
+    for row in tasks_df.itertuples(index=False):
+        values = {name: _model_value(getattr(row, name), schema[name].kind) for name in schema}
+        responsables = tuple(responsibles_by_task.get(values['id'], ()))
+        responsible_lists.append(responsables)
+        task = Task(**values, responsible_list=responsables, interactions=inter_by_task.get(values['id'], ()),
+                    items=items_by_task.get(values['id'], ()), extension_requests=extension_by_task.get(values['id'], ()))
+        kanban_data.get(task.status, kanban_data["Por hacer"]).append(task)
+    tasks_df = tasks_df.assign(responsible_list=pd.Series(responsible_lists, index=tasks_df.index, dtype=object))
+    return kanban_data, tasks_df.reset_index(drop=True)
+
+def _model_changes(model, ws_name, changes):
+    """Cambios de celdas convertidos con el esquema de la hoja a los tipos del modelo (solo campos que el modelo conoce)"""
+    names = [name for name in changes if name in model.__slots__]
+    if not names:
+        return {}
+    schema = WORKSHEET_SCHEMAS[ws_name]
+    row = apply_schema(pd.DataFrame([changes]), ws_name).iloc[0]
+    return {name: _model_value(row[name], schema[name].kind) for name in names}
+
+def patch_task(task, transaction):
+    """Copia de la tarea con las escrituras de la transacción aplicadas, sin volver a leer Sheets"""
+    def appended(ws_name, model):
+        records = [r for r in transaction.pending_records(ws_name) if _as_record_id(r.get('task_id')) == task.id]
+        if not records:
+            return ()
+        return records_by_task(apply_schema(pd.DataFrame(records), ws_name), ws_name, model).get(task.id, ())
+
+    items = tuple(replace(item, **_model_changes(TaskItem, "task_items", transaction.pending_changes("task_items", item.id)))
+                  for item in task.items)
+    return replace(task, **_model_changes(Task, "tasks", transaction.pending_changes("tasks", task.id)),
+                   items=items + appended("task_items", TaskItem),
+                   interactions=task.interactions + appended("task_interactions", Interaction),
+                   extension_requests=task.extension_requests + appended("time_extension_requests", ExtensionRequest))
+
+@dataclass(frozen=True)
+class BoardSnapshot:
+    """Copia inmutable del tablero compartida por todas las sesiones del proceso"""
+    version: int
+    loaded_at: datetime
+    kanban: dict
+    all_tasks_df: pd.DataFrame
+    row_index: dict
+    frames: dict
+    pending_revision: int = 0
+
+    @property
+    def key(self):
+        """Identifica el contenido: versión, momento de lectura y revisión de la cola write-behind"""
+        return (self.version, self.loaded_at.timestamp(), self.pending_revision)
+
+@st.cache_resource
+def _snapshot_registry():
+    """Versión actual del tablero y del archivo a nivel proceso (cada escritura la incrementa) y último snapshot leído con éxito"""
+    return {"version": 0, "archive_version": 0, "lock": threading.Lock(), "last_good": None}
+
+def current_snapshot_version():
+    return _snapshot_registry()["version"]
+
+def invalidate_board_snapshot():
+    """Marca el snapshot compartido como obsoleto; la siguiente lectura vuelve a Sheets"""
+    registry = _snapshot_registry()
+    with registry["lock"]:
+        registry["version"] += 1
+
+@st.cache_resource(ttl=SNAPSHOT_TTL_SECONDS, max_entries=2, show_spinner=False)
+def get_board_snapshot(version):
+    """Lee el tablero una sola vez por versión (y por TTL) para todas las sesiones"""
+    frames = fetch_worksheets_batch(BOARD_WORKSHEETS)
+    kanban_data, all_tasks_df = build_board(frames)
+    snapshot = BoardSnapshot(version=version, loaded_at=datetime.now(), kanban=kanban_data,
+                             all_tasks_df=all_tasks_df, row_index=build_row_index(frames), frames=frames)
+    _snapshot_registry()["last_good"] = snapshot
+    return snapshot
+
+def apply_pending_writes(frames, operations):
+    """Copia de las hojas con las escrituras pendientes de la cola aplicadas, en orden"""
+    frames = dict(frames)
+    touched = set()
+    for kind, ws_name, record_id, payload in operations:
+        if ws_name not in frames:
+            continue
+        if ws_name not in touched:
+            # en object para mezclar los valores de la cola con las columnas tipadas; al final se vuelven a tipar
+            frames[ws_name] = frames[ws_name].astype(object)
+            touched.add(ws_name)
+        payload = {col: (None if value == "" else value) for col, value in payload.items()}
+        df = frames[ws_name]
+        if kind == "append":
+            frames[ws_name] = pd.concat([df, pd.DataFrame([payload])], ignore_index=True)
+        elif 'id' in df.columns:
+            mask = df['id'].map(_as_record_id) == record_id
+            for col, value in payload.items():
+                df.loc[mask, col] = value
+    for ws_name in touched:
+        frames[ws_name] = apply_schema(frames[ws_name], ws_name)
+    return frames
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def get_pending_board(version, queue_revision):
+    """Snapshot con las escrituras aún en cola aplicadas (una vez por versión y revisión de la cola)"""
+    snapshot = get_board_snapshot(version)
+    frames = apply_pending_writes(snapshot.frames, get_write_behind_queue().pending_operations())
+    kanban_data, all_tasks_df = build_board(frames)
+    return BoardSnapshot(version=version, loaded_at=snapshot.loaded_at, kanban=kanban_data,
+                         all_tasks_df=all_tasks_df, row_index=snapshot.row_index, frames=frames,
+                         pending_revision=queue_revision)
+
+def current_board():
+    """Snapshot vigente; en modo write-behind incluye las escrituras que aún no llegan a Sheets"""
+    snapshot = get_board_snapshot(current_snapshot_version())
+    if not write_behind_enabled():
+        return snapshot
+    queue = get_write_behind_queue()
+    if not queue.pending_count():
+        return snapshot
+    return get_pending_board(snapshot.version, queue.revision)
+
+@st.cache_resource(ttl=SNAPSHOT_TTL_SECONDS * 10, max_entries=1, show_spinner=False)
+def get_archive_frames(archive_version):
+    """Hojas archive_* (con los nombres de las hojas activas) leídas en una sola llamada por versión del archivo"""
+    frames = fetch_worksheets_batch(list(ARCHIVE_WORKSHEETS.values()))
+    return {name: frames[archive] for name, archive in ARCHIVE_WORKSHEETS.items()}
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def get_history_board(board_key, archive_version):
+    """Tablero histórico (tareas activas + archivadas) para consultas y reportes; el tablero diario no lo usa"""
+    hot = current_board().frames
+    cold = get_archive_frames(archive_version)
+    frames = {name: apply_schema(pd.concat([hot[name], cold[name]], ignore_index=True), name) if not cold[name].empty
+              else hot[name] for name in BOARD_WORKSHEETS}
+    return build_board(frames)
+
+def load_task_history():
+    """(kanban, all_tasks_df) incluyendo las tareas archivadas"""
+    return get_history_board(st.session_state.get('board_key'), _snapshot_registry()["archive_version"])
+
+def load_tasks_from_db(force=False):
+    """Apunta st.session_state.kanban y all_tasks_df al snapshot compartido (force=True vuelve a leer Sheets)"""
+    if _active_transaction.get() is not None:
+        # dentro de una transacción la recarga se hace una sola vez al confirmar
+        return
+    if force:
+        invalidate_board_snapshot()
+    try:
+        snapshot = current_board()
+        st.session_state.kanban = snapshot.kanban
+        st.session_state.all_tasks_df = snapshot.all_tasks_df
+        st.session_state.row_index = snapshot.row_index
+        st.session_state.snapshot_version = snapshot.version
+        st.session_state.board_key = snapshot.key
+        st.session_state.card_patches = {}
 
     except Exception as e:
+        last_good = _snapshot_registry()["last_good"]
+        if last_good is not None:
+            # Sheets no respondió (p. ej. cuota agotada): se sigue mostrando la última copia válida
+            st.warning(f"No se pudo actualizar el tablero ({e}). Mostrando datos de {last_good.loaded_at:%H:%M:%S}.")
+            st.session_state.kanban = last_good.kanban
+            st.session_state.all_tasks_df = last_good.all_tasks_df
+            st.session_state.row_index = last_good.row_index
+            st.session_state.board_key = last_good.key
+            return
         st.error(f"Error al cargar tareas: {e}")
         st.session_state.kanban = {"Por hacer": [], "En proceso": [], "Hecho": []}
         st.session_state.all_tasks_df = pd.DataFrame()
+        st.session_state.board_key = None
+
+# ---------------------------
+# Hilo de fondo con estado en SQLite (base de write-behind y offline-first)
+# ---------------------------
+class BackgroundWorker:
+    """
+    Hilo de fondo que llama a flush() cada FLUSH_SECONDS o al despertarlo con _wake; tras un error
+    duplica la espera (hasta 60 s) y lo deja en last_error. Su estado vive en un archivo SQLite local
+    cuyas tablas crea _setup(conn).
+    """
+    FLUSH_SECONDS = 30
+    THREAD_NAME = "kanban-background"
+
+    def __init__(self, path, registry):
+        self._path = path
+        self._registry = registry
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.revision = 0
+        self.last_error = None
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._setup(conn)
+        self._thread = threading.Thread(target=self._run, name=self.THREAD_NAME, daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30)
+
+    def _setup(self, conn):
+        raise NotImplementedError
+
+    def _run(self):
+        delay = self.FLUSH_SECONDS
+        while True:
+            self._wake.wait(delay)
+            self._wake.clear()
+            try:
+                self.flush()
+                self.last_error = None
+                delay = self.FLUSH_SECONDS
+            except Exception as e:
+                self.last_error = str(e)
+                delay = min(delay * 2, 60)
+
+    def flush(self):
+        raise NotImplementedError
+
+# ---------------------------
+# Cola de escritura diferida (write-behind)
+# ---------------------------
+class WriteBehindQueue(BackgroundWorker):
+    """
+    Cola local durable (SQLite) de escrituras pendientes.
+    Los cambios de celdas sobre el mismo registro se fusionan mientras esperan (varios avances
+    de la misma tarea se envían como uno) y un hilo de fondo los manda a Sheets en lote.
+    """
+    FLUSH_SECONDS = WRITE_BEHIND_FLUSH_SECONDS
+    THREAD_NAME = "kanban-write-behind"
+
+    def __init__(self, path, spreadsheet, handles, headers, registry):
+        self._spreadsheet = spreadsheet
+        self._handles = handles
+        self._headers = headers
+        super().__init__(path, registry)
+
+    def _setup(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS pending_writes (
+                            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                            kind TEXT NOT NULL,
+                            worksheet TEXT NOT NULL,
+                            record_id INTEGER,
+                            payload TEXT NOT NULL,
+                            claimed INTEGER NOT NULL DEFAULT 0)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_target ON pending_writes(worksheet, record_id)")
+        # lo que quedó a medio enviar en el proceso anterior se vuelve a intentar
+        conn.execute("UPDATE pending_writes SET claimed = 0")
+
+    def enqueue(self, appends, updates):
+        with self._lock, closing(self._connect()) as conn, conn:
+            for ws_name, records in appends.items():
+                for record in records:
+                    payload = {col: _cell_value(value) for col, value in record.items()}
+                    conn.execute("INSERT INTO pending_writes (kind, worksheet, record_id, payload) VALUES ('append', ?, ?, ?)",
+                                 (ws_name, _as_record_id(record.get('id')), json.dumps(payload, default=str)))
+            for ws_name, records in updates.items():
+                for record_id, changes in records.items():
+                    changes = {col: _cell_value(value) for col, value in changes.items()}
+                    # fusionar con la última escritura pendiente (no enviada aún) del mismo registro
+                    pending = conn.execute("""SELECT seq, payload FROM pending_writes
+                                              WHERE worksheet = ? AND record_id = ? AND claimed = 0
+                                              ORDER BY seq DESC LIMIT 1""", (ws_name, int(record_id))).fetchone()
+                    if pending:
+                        merged = json.loads(pending[1])
+                        merged.update(changes)
+                        conn.execute("UPDATE pending_writes SET payload = ? WHERE seq = ?",
+                                     (json.dumps(merged, default=str), pending[0]))
+                    else:
+                        conn.execute("INSERT INTO pending_writes (kind, worksheet, record_id, payload) VALUES ('update', ?, ?, ?)",
+                                     (ws_name, int(record_id), json.dumps(changes, default=str)))
+            self.revision += 1
+        self._wake.set()
+
+    def pending_count(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM pending_writes").fetchone()[0]
+
+    def has_pending_record(self, ws_name, record_id):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT 1 FROM pending_writes WHERE worksheet = ? AND record_id = ? LIMIT 1",
+                                (ws_name, int(record_id))).fetchone() is not None
+
+    def pending_operations(self):
+        """[(tipo, hoja, id, payload)] en orden de llegada"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT kind, worksheet, record_id, payload FROM pending_writes ORDER BY seq").fetchall()
+        return [(kind, ws_name, record_id, json.loads(payload)) for kind, ws_name, record_id, payload in rows]
+
+    def flush(self):
+        with self._lock, closing(self._connect()) as conn, conn:
+            rows = conn.execute("""SELECT seq, kind, worksheet, record_id, payload FROM pending_writes
+                                   WHERE claimed = 0 ORDER BY seq""").fetchall()
+            conn.executemany("UPDATE pending_writes SET claimed = 1 WHERE seq = ?", [(row[0],) for row in rows])
+        if not rows:
+            return
+        try:
+            self._send(rows)
+        except Exception:
+            # lo ya enviado se quitó de la cola en cada etapa; solo se reintenta el resto
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.executemany("UPDATE pending_writes SET claimed = 0 WHERE seq = ?", [(row[0],) for row in rows])
+            raise
+
+    def _complete(self, seqs):
+        """Quita de la cola las escrituras que ya llegaron a Sheets"""
+        if not seqs:
+            return
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM pending_writes WHERE seq = ?", [(seq,) for seq in seqs])
+            self.revision += 1
+        with self._registry["lock"]:
+            self._registry["version"] += 1
+
+    def _rows_by_id(self, ws_names):
+        """{hoja: {id: fila}} leyendo solo la columna de ids de las hojas indicadas"""
+        ws_names = sorted(ws_names)
+        if not ws_names:
+            return {}
+        response = self._spreadsheet.values_batch_get([absolute_range_name(name, "A:A") for name in ws_names],
+                                                      params={"valueRenderOption": "UNFORMATTED_VALUE"})
+        rows_by_id = {}
+        for ws_name, value_range in zip(ws_names, response.get("valueRanges", [])):
+            ids = [values[0] if values else None for values in value_range.get("values", [])]
+            rows_by_id[ws_name] = {_as_record_id(value): row for row, value in enumerate(ids[1:], start=2)}
+        return rows_by_id
+
+    def _send(self, rows):
+        appends = {}
+        updates = []
+        for seq, kind, ws_name, record_id, payload in rows:
+            if kind == "append":
+                appends.setdefault(ws_name, []).append((seq, json.loads(payload)))
+            else:
+                updates.append((seq, ws_name, record_id, json.loads(payload)))
+        # ids que ya están en la hoja: una alta enviada antes de un fallo no se vuelve a agregar
+        keyed = {ws_name for ws_name in appends if (self._headers.get(ws_name) or WORKSHEET_COLUMNS[ws_name])[:1] == ["id"]}
+        rows_by_id = self._rows_by_id(keyed | {ws_name for _, ws_name, _, _ in updates})
+        for ws_name, records in appends.items():
+            columns = self._headers.get(ws_name) or WORKSHEET_COLUMNS[ws_name]
+            known = rows_by_id.get(ws_name, {}) if ws_name in keyed else {}
+            new = [record for _, record in records
+                   if _as_record_id(record.get('id')) is None or _as_record_id(record.get('id')) not in known]
+            if new:
+                values = [[record.get(col, "") for col in columns] for record in new]
+                self._handles[ws_name].append_rows(values, value_input_option="USER_ENTERED", table_range="A1")
+            self._complete([seq for seq, _ in records])
+        if not updates:
+            return
+        # los registros agregados en esta misma tanda aún no tienen fila conocida
+        appended = {ws_name for _, ws_name, record_id, _ in updates if record_id not in rows_by_id.get(ws_name, {})}
+        rows_by_id.update(self._rows_by_id(appended & set(appends)))
+        data = []
+        for _, ws_name, record_id, changes in updates:
+            row = rows_by_id.get(ws_name, {}).get(record_id)
+            if row is None:
+                continue
+            columns = self._headers.get(ws_name) or WORKSHEET_COLUMNS[ws_name]
+            data.extend({"range": absolute_range_name(ws_name, rowcol_to_a1(row, columns.index(col) + 1)),
+                         "values": [[value]]} for col, value in changes.items())
+        if data:
+            self._spreadsheet.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+        self._complete([seq for seq, _, _, _ in updates])
+
+@st.cache_resource
+def get_write_behind_queue():
+    return WriteBehindQueue(WRITE_BEHIND_QUEUE_PATH, get_gsheet_connection(), get_worksheet_handles(),
+                            bootstrap_schema(SCHEMA_VERSION), _snapshot_registry())
+
+# ---------------------------
+# Modo offline-first (réplica local + diario de cambios)
+# ---------------------------
+def _key_value(value):
+    """Forma común de un valor de Sheets o de la réplica para compararlos"""
+    if value is None or value == "":
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+def _row_version(values):
+    """Versión de una fila de Sheets: huella de sus valores (cambia si alguien la modifica)"""
+    return hashlib.sha1(json.dumps([_key_value(v) for v in values]).encode()).hexdigest()
+
+class OfflineSync(BackgroundWorker):
+    """
+    Sincronización del modo offline-first. Cada escritura se aplica a la réplica SQLite y se anota en un diario
+    de solo agregado (journal) del mismo archivo. El hilo de fondo, cada OFFLINE_SYNC_SECONDS o al anotar
+    un cambio, lee las hojas con una sola llamada batch, actualiza en la réplica solo las filas que cambiaron
+    y envía el diario. Un cambio cuya fila fue modificada en Sheets desde la última lectura (otra versión
+    de fila) queda en conflicto: no se envía y la réplica toma el valor de Sheets.
+    """
+    FLUSH_SECONDS = OFFLINE_SYNC_SECONDS
+    THREAD_NAME = "kanban-offline-sync"
+
+    def __init__(self, path, registry):
+        self._last_attach = float("-inf")
+        # una sola sincronización a la vez (hilo de fondo y archivado pueden pedirla juntos)
+        self._sync_lock = threading.Lock()
+        self.last_sync = None
+        self._spreadsheet = None
+        self._handles = {}
+        self._headers = {}
+        super().__init__(path, registry)
+
+    def _setup(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS journal (
+                            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                            kind TEXT NOT NULL,
+                            worksheet TEXT NOT NULL,
+                            record_key TEXT,
+                            payload TEXT NOT NULL,
+                            base_version TEXT,
+                            status TEXT NOT NULL DEFAULT 'pending',
+                            created_at TEXT NOT NULL,
+                            synced_at TEXT)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_status ON journal(status, seq)")
+        # versión de cada fila de Sheets en la última lectura (record_id 0 = hoja completa, para hojas sin id)
+        conn.execute("""CREATE TABLE IF NOT EXISTS sync_versions (
+                            worksheet TEXT NOT NULL,
+                            record_id INTEGER NOT NULL,
+                            version TEXT NOT NULL,
+                            PRIMARY KEY (worksheet, record_id))""")
+        # bloques de ids ya reservados en id_counters, para crear registros sin conexión
+        conn.execute("""CREATE TABLE IF NOT EXISTS id_stock (
+                            worksheet TEXT NOT NULL,
+                            next_id INTEGER NOT NULL,
+                            end_id INTEGER NOT NULL)""")
+
+    @property
+    def attached(self):
+        return self._spreadsheet is not None
+
+    def attach(self, connect):
+        """Conecta el hilo a Sheets con connect() -> (spreadsheet, handles, encabezados); reintenta como mucho cada FLUSH_SECONDS"""
+        now = time.monotonic()
+        if self.attached or now - self._last_attach < self.FLUSH_SECONDS:
+            return
+        self._last_attach = now
+        try:
+            spreadsheet, self._handles, self._headers = connect()
+            self._spreadsheet = spreadsheet
+            self._wake.set()
+        except Exception as e:
+            self.last_error = str(e)
+
+    def record(self, entries, apply):
+        """Anota [(tipo, hoja, clave, payload)] en el diario y luego aplica el cambio en la réplica con apply()"""
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            with closing(self._connect()) as conn, conn:
+                for kind, ws_name, key, payload in entries:
+                    base_version = None
+                    if key and "id" in key:
+                        found = conn.execute("SELECT version FROM sync_versions WHERE worksheet = ? AND record_id = ?",
+                                             (ws_name, key["id"])).fetchone()
+                        base_version = found[0] if found else None
+                    payload = {col: _cell_value(value) for col, value in payload.items()}
+                    conn.execute("""INSERT INTO journal (kind, worksheet, record_key, payload, base_version, created_at)
+                                    VALUES (?, ?, ?, ?, ?, ?)""",
+                                 (kind, ws_name, json.dumps(key, default=str) if key else None,
+                                  json.dumps(payload, default=str), base_version, created_at))
+            apply()
+            self.revision += 1
+        self._wake.set()
+
+    def take_ids(self, ws_name, size, floor):
+        """Toma size ids consecutivos de los bloques reservados; None si no alcanza ninguno"""
+        with self._lock, closing(self._connect()) as conn, conn:
+            blocks = conn.execute("SELECT rowid, next_id, end_id FROM id_stock WHERE worksheet = ? ORDER BY next_id",
+                                  (ws_name,)).fetchall()
+            for rowid, next_id, end_id in blocks:
+                start = max(next_id, floor)
+                if end_id - start >= size:
+                    conn.execute("UPDATE id_stock SET next_id = ? WHERE rowid = ?", (start + size, rowid))
+                    return start, start + size
+        return None
+
+    def pending_count(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM journal WHERE status = 'pending'").fetchone()[0]
+
+    def conflicts(self, limit=20):
+        """[(fecha, hoja, clave, payload)] de los cambios no enviados por conflicto que aún conserva el diario"""
+        since = (datetime.now() - timedelta(hours=OFFLINE_JOURNAL_KEEP_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+        with closing(self._connect()) as conn:
+            rows = conn.execute("""SELECT created_at, worksheet, record_key, payload FROM journal
+                                   WHERE status = 'conflict' AND created_at >= ? ORDER BY seq DESC LIMIT ?""",
+                                (since, limit)).fetchall()
+        return [(created_at, ws_name, json.loads(key) if key else None, json.loads(payload))
+                for created_at, ws_name, key, payload in rows]
+
+    def flush(self):
+        if not self.attached:
+            return
+        with self._sync_lock:
+            remote = self._pull()
+            changed = self._apply_remote(remote)
+            self._push(remote)
+            self._top_up_ids(remote)
+            self._prune()
+            self.last_sync = datetime.now()
+        if changed:
+            with self._registry["lock"]:
+                self._registry["version"] += 1
+
+    def _prune(self):
+        """Quita del diario las entradas ya resueltas (enviadas o en conflicto) con más de OFFLINE_JOURNAL_KEEP_HOURS"""
+        before = (datetime.now() - timedelta(hours=OFFLINE_JOURNAL_KEEP_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM journal WHERE status != 'pending' AND synced_at < ?", (before,))
+
+    def _columns(self, ws_name):
+        return self._headers.get(ws_name) or WORKSHEET_COLUMNS[ws_name]
+
+    def _pull(self):
+        """Lee todas las hojas (salvo id_counters) en una sola llamada; devuelve {hoja: (encabezado, filas, {id: fila})}"""
+        names = [name for name in WORKSHEET_COLUMNS if name != "id_counters"]
+        ranges = [absolute_range_name(name, f"A:{rowcol_to_a1(1, len(self._columns(name)))[:-1]}") for name in names]
+        response = self._spreadsheet.values_batch_get(ranges, params=_READ_PARAMS)
+        value_ranges = response.get("valueRanges", [])
+        remote = {}
+        for i, name in enumerate(names):
+            values = value_ranges[i].get("values", []) if i < len(value_ranges) else []
+            header = self._columns(name)
+            rows = []
+            for row_number, row in enumerate(values[1:], start=2):
+                row = [None if v == "" else v for v in list(row[:len(header)]) + [None] * (len(header) - len(row))]
+                if row and row[0] is not None:
+                    rows.append((row_number, row))
+            by_id = {}
+            if "id" in header:
+                position = header.index("id")
+                by_id = {_as_record_id(row[position]): (row_number, row) for row_number, row in rows}
+                by_id.pop(None, None)
+            remote[name] = (header, rows, by_id)
+        return remote
+
+    def _apply_remote(self, remote):
+        """Copia a la réplica las filas que cambiaron en Sheets, salvo las que tienen cambios locales pendientes"""
+        changed = False
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            pending = conn.execute("SELECT kind, worksheet, record_key, payload FROM journal WHERE status = 'pending'").fetchall()
+            blocked, pending_ids = set(), set()
+            for kind, ws_name, key, payload in pending:
+                key = json.loads(key) if key else {}
+                record_id = key.get("id", json.loads(payload).get("id") if kind == "append" else None)
+                if kind in ("delete", "clear") or _as_record_id(record_id) is None:
+                    blocked.add(ws_name)
+                else:
+                    pending_ids.add((ws_name, _as_record_id(record_id)))
+            for ws_name, (header, rows, by_id) in remote.items():
+                if ws_name in blocked:
+                    continue
+                columns = [info[1] for info in conn.execute(f'PRAGMA table_info("{ws_name}")') if info[1] in header]
+                positions = [header.index(col) for col in columns]
+                versions = dict(conn.execute("SELECT record_id, version FROM sync_versions WHERE worksheet = ?", (ws_name,)))
+                if "id" not in header:
+                    version = _row_version([v for _, row in rows for v in row])
+                    if versions.get(0) == version:
+                        continue
+                    conn.execute(f'DELETE FROM "{ws_name}"')
+                    conn.executemany(f'INSERT INTO "{ws_name}" ({_quoted(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                                     [[_sqlite_value(row[p]) for p in positions] for _, row in rows])
+                    conn.execute("INSERT OR REPLACE INTO sync_versions VALUES (?, 0, ?)", (ws_name, version))
+                    changed = True
+                    continue
+                assignments = ", ".join(f'"{col}" = ?' for col in columns)
+                for record_id, (_, row) in by_id.items():
+                    version = _row_version(row)
+                    if (ws_name, record_id) in pending_ids or versions.get(record_id) == version:
+                        continue
+                    values = [_sqlite_value(row[p]) for p in positions]
+                    # UPDATE primero para conservar el rowid (número de fila) del registro en la réplica
+                    if conn.execute(f'UPDATE "{ws_name}" SET {assignments} WHERE id = ?', values + [record_id]).rowcount == 0:
+                        conn.execute(f'INSERT INTO "{ws_name}" ({_quoted(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                                     values)
+                    conn.execute("INSERT OR REPLACE INTO sync_versions VALUES (?, ?, ?)", (ws_name, record_id, version))
+                    changed = True
+                # filas que ya se habían visto en Sheets y desaparecieron (archivadas o borradas por otro usuario)
+                gone = [(record_id,) for record_id in versions
+                        if record_id not in by_id and (ws_name, record_id) not in pending_ids]
+                if gone:
+                    conn.executemany(f'DELETE FROM "{ws_name}" WHERE id = ?', gone)
+                    conn.executemany("DELETE FROM sync_versions WHERE worksheet = ? AND record_id = ?",
+                                     [(ws_name, record_id) for record_id, in gone])
+                    changed = True
+        return changed
+
+    def _remote_row(self, remote, ws_name, key):
+        """(número de fila, valores) en Sheets del registro identificado por key, o None"""
+        header, rows, by_id = remote.get(ws_name, ([], [], {}))
+        if "id" in key:
+            return by_id.get(key["id"])
+        for row_number, row in rows:
+            if all(col in header and _key_value(row[header.index(col)]) == _key_value(value) for col, value in key.items()):
+                return row_number, row
+        return None
+
+    def _push(self, remote):
+        """Envía la primera tanda del diario: altas y cambios juntos, o borrados/limpiezas (que desplazan filas) solos"""
+        with closing(self._connect()) as conn:
+            entries = conn.execute("""SELECT seq, kind, worksheet, record_key, payload, base_version FROM journal
+                                      WHERE status = 'pending' ORDER BY seq""").fetchall()
+        if not entries:
+            return
+        structural = entries[0][1] in ("delete", "clear")
+        batch = []
+        for entry in entries:
+            if (entry[1] in ("delete", "clear")) != structural:
+                break
+            batch.append(entry)
+        if structural:
+            results, touched = {}, set()
+            self._send_structural(remote, batch, results, touched)
+            self._mark(results, touched)
+        else:
+            self._send_changes(remote, batch)
+        if len(batch) < len(entries):
+            self._wake.set()
+
+    def _mark(self, results, touched):
+        """Guarda el estado de las entradas ya enviadas ({seq: estado}) apenas termina cada envío"""
+        synced_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany("UPDATE journal SET status = ?, synced_at = ? WHERE seq = ?",
+                             [(status, synced_at, seq) for seq, status in results.items()])
+            # la próxima lectura vuelve a fijar la versión de estas filas (y las que quedaron en conflicto toman el valor de Sheets)
+            conn.executemany("DELETE FROM sync_versions WHERE worksheet = ? AND record_id = ?", touched)
+
+    def _send_changes(self, remote, batch):
+        """Envía cambios de celdas y luego las altas de cada hoja; el diario se actualiza después de cada envío"""
+        appends, appended, data = {}, {}, []
+        cell_results, cell_touched = {}, set()
+        append_results, append_touched = {}, {}
+        for seq, kind, ws_name, key, payload, base_version in batch:
+            key, payload = json.loads(key) if key else None, json.loads(payload)
+            if kind == "append":
+                appends.setdefault(ws_name, []).append(payload)
+                append_results.setdefault(ws_name, {})[seq] = "synced"
+                record_id = _as_record_id(payload.get("id"))
+                if record_id is not None and record_id not in remote.get(ws_name, ([], [], {}))[2]:
+                    appended[(ws_name, record_id)] = payload
+                continue
+            if (ws_name, key.get("id")) in appended:
+                # el alta va en la misma tanda: el cambio se envía dentro de ella
+                appended[(ws_name, key["id"])].update(payload)
+                append_results[ws_name][seq] = "synced"
+                append_touched.setdefault(ws_name, set()).add((ws_name, key["id"]))
+                continue
+            cell_touched.add((ws_name, key.get("id", 0)))
+            cell_results[seq] = "synced"
+            found = self._remote_row(remote, ws_name, key)
+            header = remote.get(ws_name, ([],))[0]
+            if found is None:
+                cell_results[seq] = "conflict"
+                continue
+            row, values = found
+            already_applied = all(col in header and _key_value(values[header.index(col)]) == _key_value(value)
+                                  for col, value in payload.items())
+            if already_applied:
+                continue
+            if base_version is not None and _row_version(values) != base_version:
+                cell_results[seq] = "conflict"
+                continue
+            columns = self._columns(ws_name)
+            data.extend({"range": absolute_range_name(ws_name, rowcol_to_a1(row, columns.index(col) + 1)),
+                         "values": [[value]]} for col, value in payload.items() if col in columns)
+        if data:
+            self._spreadsheet.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+        self._mark(cell_results, cell_touched)
+        for ws_name, records in appends.items():
+            # una alta cuyo id ya está en Sheets (envío anterior interrumpido) no se vuelve a agregar
+            known = remote.get(ws_name, ([], [], {}))[2]
+            new = [record for record in records
+                   if _as_record_id(record.get("id")) is None or _as_record_id(record.get("id")) not in known]
+            if new:
+                columns = self._columns(ws_name)
+                values = [[record.get(col, "") for col in columns] for record in new]
+                self._handles[ws_name].append_rows(values, value_input_option="USER_ENTERED", table_range="A1")
+            self._mark(append_results[ws_name], append_touched.get(ws_name, set()))
+
+    def _send_structural(self, remote, batch, results, touched):
+        rows_by_sheet, clears = {}, []
+        for seq, kind, ws_name, key, _, _ in batch:
+            results[seq] = "synced"
+            if kind == "clear":
+                clears.append(ws_name)
+                touched.update((ws_name, record_id) for record_id in [0] + list(remote.get(ws_name, ([], [], {}))[2]))
+                continue
+            key = json.loads(key)
+            touched.add((ws_name, key.get("id", 0)))
+            found = self._remote_row(remote, ws_name, key)
+            # si ya no está en Sheets no hay nada que borrar
+            if found is not None:
+                rows_by_sheet.setdefault(ws_name, set()).add(found[0])
+        requests_body = []
+        for ws_name, rows in rows_by_sheet.items():
+            requests_body.extend({"deleteDimension": {"range": {"sheetId": self._handles[ws_name].id, "dimension": "ROWS",
+                                                                "startIndex": start - 1, "endIndex": end}}}
+                                 for start, end in _row_ranges(rows))
+        if requests_body:
+            self._spreadsheet.batch_update({"requests": requests_body})
+        for ws_name in clears:
+            self._handles[ws_name].clear()
+            self._handles[ws_name].update(values=[WORKSHEET_COLUMNS[ws_name]], range_name="A1")
+
+    def _top_up_ids(self, remote):
+        """Repone los bloques de ids reservados de las hojas con id mientras hay conexión"""
+        for ws_name in BOARD_WORKSHEETS:
+            if "id" not in WORKSHEET_SCHEMAS[ws_name]:
+                continue
+            with self._lock, closing(self._connect()) as conn, conn:
+                # los restos menores a un bloque del asignador no se pueden usar
+                conn.execute("DELETE FROM id_stock WHERE worksheet = ? AND end_id - next_id < ?", (ws_name, ID_BLOCK_SIZE))
+                stock = conn.execute("SELECT COALESCE(SUM(end_id - next_id), 0) FROM id_stock WHERE worksheet = ?",
+                                     (ws_name,)).fetchone()[0]
+            if stock >= OFFLINE_ID_STOCK:
+                continue
+            floor = max(remote.get(ws_name, ([], [], {}))[2], default=0) + 1
+            start, end = _reserve_sheet_ids(self._handles["id_counters"], ws_name, OFFLINE_ID_STOCK, floor)
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute("INSERT INTO id_stock (worksheet, next_id, end_id) VALUES (?, ?, ?)", (ws_name, start, end))
+
+@st.cache_resource
+def get_offline_sync():
+    return OfflineSync(get_setting("sqlite_path", SQLITE_PATH), _snapshot_registry())
+
+def connect_offline_sync():
+    """Conecta el hilo de sincronización a Sheets en cuanto haya conexión (sin bloquear el tablero mientras no la haya)"""
+    get_offline_sync().attach(lambda: (get_gsheet_connection(), get_worksheet_handles(), SheetsStorage().ensure_schema()))
+
+class OfflineFirstStorage(SQLiteStorage):
+    """
+    Réplica local del modo offline-first: lee como SQLiteStorage y cada escritura se anota además en el diario
+    de OfflineSync, que la envía a Sheets en segundo plano. Las filas se identifican por id o, en las hojas
+    sin id, por sus valores.
+    """
+    def __init__(self, path, sync):
+        super().__init__(path)
+        self._sync = sync
+
+    def _row_keys(self, ws_name, rows):
+        """{rowid: clave} de las filas indicadas de la réplica"""
+        if not rows:
+            return {}
+        columns = ["id"] if "id" in WORKSHEET_SCHEMAS.get(ws_name, {}) else worksheet_columns(ws_name)
+        with closing(self._connect()) as conn:
+            found = conn.execute(f'SELECT rowid, {_quoted(columns)} FROM "{ws_name}" WHERE rowid IN ({", ".join("?" * len(rows))})',
+                                 [int(row) for row in rows]).fetchall()
+        return {values[0]: {col: _cell_value(value) for col, value in zip(columns, values[1:])} for values in found}
+
+    def write(self, appends, updates):
+        entries = [("append", ws_name, None, record) for ws_name, records in appends.items() for record in records]
+        entries += [("update", ws_name, {"id": int(record_id)}, changes)
+                    for ws_name, records in updates.items() for record_id, changes in records.items() if changes]
+        self._sync.record(entries, lambda: SQLiteStorage.write(self, appends, updates))
+
+    def update_rows(self, ws_name, changes_by_row):
+        keys = self._row_keys(ws_name, list(changes_by_row))
+        entries = [("update", ws_name, keys[row], changes) for row, changes in changes_by_row.items() if row in keys]
+        self._sync.record(entries, lambda: SQLiteStorage.update_rows(self, ws_name, changes_by_row))
+
+    def delete_rows(self, rows_by_sheet):
+        entries = []
+        for ws_name, rows in rows_by_sheet.items():
+            entries += [("delete", ws_name, key, {}) for key in self._row_keys(ws_name, list(rows)).values()]
+        self._sync.record(entries, lambda: SQLiteStorage.delete_rows(self, rows_by_sheet))
+
+    def clear(self, names):
+        self._sync.record([("clear", ws_name, None, {}) for ws_name in names],
+                          lambda: SQLiteStorage.clear(self, names))
+
+    def reserve_ids(self, ws_name, size, floor):
+        # ids de los bloques reservados en Sheets por el hilo; si no alcanzan, se reservan en Sheets directamente
+        block = self._sync.take_ids(ws_name, size, floor)
+        if block is None:
+            try:
+                block = SheetsStorage().reserve_ids(ws_name, size, floor)
+            except Exception as e:
+                # sin conexión y sin bloque reservado no hay id seguro: se detiene la acción antes de escribir nada
+                st.error(f"No hay ids disponibles sin conexión para '{ws_name}': se reservan al sincronizar con "
+                         f"Google Sheets. Intente de nuevo cuando vuelva la conexión. ({e})")
+                st.stop()
+        return block
+
+class IdAllocator:
+    """
+    Entrega ids únicos por hoja sin leer las hojas de datos.
+    Reserva bloques de ID_BLOCK_SIZE en la tabla id_counters y los reparte bajo un lock: dos sesiones del mismo
+    proceso nunca reciben el mismo id, y entre procesos la reserva se confirma en el almacenamiento
+    (fila de reserva verificada en Sheets, transacción BEGIN IMMEDIATE en SQLite).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def allocate(self, ws_name, count=1):
+        with self._lock:
+            next_id, end = self._blocks.get(ws_name, (0, 0))
+            if end - next_id < count:
+                next_id, end = self._reserve_block(ws_name, max(count, ID_BLOCK_SIZE))
+            self._blocks[ws_name] = (next_id + count, end)
+            return list(range(next_id, next_id + count))
+
+    def _reserve_block(self, ws_name, size):
+        # nunca por debajo del mayor id ya cargado en el snapshot
+        snapshot = get_board_snapshot(current_snapshot_version())
+        floor = max(snapshot.row_index.get(ws_name, {}), default=0) + 1
+        return get_storage().reserve_ids(ws_name, size, floor)
+
+@st.cache_resource
+def get_id_allocator():
+    return IdAllocator()
+
+def allocate_ids(ws_name, count=1):
+    """Reserva count ids consecutivos para la hoja"""
+    return get_id_allocator().allocate(ws_name, count)
 
 def add_task_to_db(task_data, initial_status, responsible_usernames):
-    sheet = get_gsheet_connection()
-    ws_tasks = sheet.worksheet("tasks")
-    ws_collab = sheet.worksheet("task_collaborators")
-
-    df_tasks = get_as_dataframe(ws_tasks)
-    df_tasks = df_tasks[df_tasks.iloc[:, 0].notna()].copy() if not df_tasks.empty else pd.DataFrame(columns=['id','task','description','date','priority','shift','start_date','due_date','status','completion_date','progress','created_by','document_links'])
-    new_id = 1
-    if not df_tasks.empty and 'id' in df_tasks.columns:
-        df_tasks['id'] = pd.to_numeric(df_tasks['id'], errors='coerce').fillna(0).astype(int)
-        new_id = int(df_tasks["id"].max() + 1)
+    """Agrega la tarea y sus responsables; devuelve el id asignado"""
+    new_id = allocate_ids("tasks")[0]
     task_data['id'] = new_id
     task_data['status'] = initial_status
     task_data['completion_date'] = None
     task_data['progress'] = 0
     task_data['created_by'] = st.session_state.username
-    new_task_df = pd.DataFrame([task_data])
-
-    # Alinear columnas
-    existing_cols = df_tasks.columns.tolist()
-    new_task_cols = new_task_df.columns.tolist()
-    for col in existing_cols:
-        if col not in new_task_cols:
-            new_task_df[col] = None
-    for col in new_task_cols:
-        if col not in existing_cols:
-            df_tasks[col] = None
-    if not df_tasks.empty:
-        new_task_df = new_task_df[df_tasks.columns]
-    df_tasks = pd.concat([df_tasks, new_task_df], ignore_index=True)
-    set_with_dataframe(ws_tasks, df_tasks)
+    append_records("tasks", [task_data])
 
     # colaboradores
-    df_collab = get_as_dataframe(ws_collab)
-    df_collab = df_collab[df_collab.iloc[:, 0].notna()].copy() if not df_collab.empty else pd.DataFrame(columns=['task_id','username'])
-    new_collabs = pd.DataFrame([{"task_id": new_id, "username": u} for u in responsible_usernames])
-    df_collab = pd.concat([df_collab, new_collabs], ignore_index=True)
-    set_with_dataframe(ws_collab, df_collab)
+    append_records("task_collaborators", [{"task_id": new_id, "username": u} for u in responsible_usernames])
 
     st.success("✅ Tarea agregada a Google Sheets.")
     load_tasks_from_db()
+    return new_id
 
 def update_task_status_in_db(task_id, new_status=None, completion_date=None, progress=None):
-    sheet = get_gsheet_connection()
-    ws = sheet.worksheet("tasks")
-    df = get_as_dataframe(ws)
-    df = df[df.iloc[:, 0].notna()].copy() if not df.empty else pd.DataFrame()
-    if df.empty:
-        return
-    if 'id' in df.columns:
-        df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(-1).astype(int)
-    mask = df["id"] == task_id
+    changes = {}
     if new_status:
-        df.loc[mask, "status"] = new_status
+        changes["status"] = new_status
     if completion_date:
-        df.loc[mask, "completion_date"] = completion_date
+        changes["completion_date"] = completion_date
     if progress is not None:
-        df.loc[mask, "progress"] = progress
-    set_with_dataframe(ws, df)
+        changes["progress"] = progress
+    if not changes or not update_record_cells("tasks", task_id, changes):
+        return
     st.success("✅ Estado de tarea actualizado en Google Sheets.")
     load_tasks_from_db()
 
-def add_task_interaction(task_id, username, action_type, comment_text=None, image_base64=None, new_status=None, progress_value=None):
-    sheet = get_gsheet_connection()
-    ws = sheet.worksheet("task_interactions")
-    df = get_as_dataframe(ws)
-    df = df[df.iloc[:, 0].notna()].copy() if not df.empty else pd.DataFrame(columns=['id','task_id','username','action_type','timestamp','comment_text','image_base64','new_status','progress_value'])
-    new_id = 1
-    if not df.empty and 'id' in df.columns:
-        df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(int)
-        new_id = int(df['id'].max() + 1)
+def add_task_interaction(task_id, username, action_type, comment_text=None, image_ref=None, new_status=None, progress_value=None, thumbnail_ref=None, image_base64=None):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     new_row = {
-        "id": new_id,
+        "id": allocate_ids("task_interactions")[0],
         "task_id": task_id,
         "username": username,
         "action_type": action_type,
         "timestamp": timestamp,
         "comment_text": comment_text,
         "image_base64": image_base64,
+        "image_ref": image_ref,
+        "thumbnail_ref": thumbnail_ref,
         "new_status": new_status,
         "progress_value": progress_value
     }
-    new_row_df = pd.DataFrame([new_row])
-    # mantener orden de columnas
-    if not df.empty:
-        for col in df.columns:
-            if col not in new_row_df.columns:
-                new_row_df[col] = None
-        new_row_df = new_row_df[df.columns]
-    df = pd.concat([df, new_row_df], ignore_index=True)
-    set_with_dataframe(ws, df)
+    append_records("task_interactions", [new_row])
     st.success("Interacción registrada en Google Sheets.")
     load_tasks_from_db()
 
 # -------------------------
 # Funciones para extension requests
 # -------------------------
-def request_time_extension(task_id, username, current_due_date, requested_due_date, reason):
-    """Crea una nueva solicitud de extensión de tiempo"""
+def request_time_extension(task_id, username, current_due_date, requested_due_date, reason, reload=True):
+    """
+    Crea una nueva solicitud de extensión de tiempo en su propia transacción (no debe llamarse dentro de otra).
+    Devuelve la transacción ya enviada, o None si falló.
+    """
     try:
-        sheet = get_gsheet_connection()
-        ws = sheet.worksheet("time_extension_requests")
-        df = get_as_dataframe(ws)
-        df = df[df.iloc[:, 0].notna()].copy() if not df.empty else pd.DataFrame(columns=['id','task_id','username','request_date','current_due_date','requested_due_date','reason','status','approved_by','decision_date'])
-
-        # Calcular nuevo ID
-        new_id = 1
-        if not df.empty and 'id' in df.columns:
-            df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(int)
-            new_id = int(df['id'].max() + 1)
-
-        # Crear nueva solicitud
-        request_date = date.today().strftime("%Y-%m-%d")
-        new_request = {
-            "id": new_id,
-            "task_id": task_id,
-            "username": username,
-            "request_date": request_date,
-            "current_due_date": current_due_date,
-            "requested_due_date": requested_due_date,
-            "reason": reason,
-            "status": "Pendiente",  # Estados: Pendiente, Aprobada, Rechazada
-            "approved_by": None,
-            "decision_date": None
-        }
-
-        # Agregar a la hoja
-        new_df = pd.DataFrame([new_request])
-        if not df.empty:
-            # Asegurar que las columnas coincidan
-            for col in df.columns:
-                if col not in new_df.columns:
-                    new_df[col] = None
-            new_df = new_df[df.columns]
-        df = pd.concat([df, new_df], ignore_index=True)
-        set_with_dataframe(ws, df)
-
-        # Registrar interacción
-        add_task_interaction(task_id, username, "extension_request",
-                            comment_text=f"Solicitada extensión de tiempo hasta {requested_due_date}. Razón: {reason}")
+        with board_transaction(reload=reload) as transaction:
+            new_id = allocate_ids("time_extension_requests")[0]
+
+            # Crear nueva solicitud
+            request_date = date.today().strftime("%Y-%m-%d")
+            new_request = {
+                "id": new_id,
+                "task_id": task_id,
+                "username": username,
+                "request_date": request_date,
+                "current_due_date": current_due_date,
+                "requested_due_date": requested_due_date,
+                "reason": reason,
+                "status": "Pendiente",  # Estados: Pendiente, Aprobada, Rechazada
+                "approved_by": None,
+                "decision_date": None
+            }
+
+            # Agregar a la hoja
+            append_records("time_extension_requests", [new_request])
+
+            # Registrar interacción
+            add_task_interaction(task_id, username, "extension_request",
+                                comment_text=f"Solicitada extensión de tiempo hasta {requested_due_date}. Razón: {reason}")
 
         st.success("✅ Solicitud de extensión enviada. Pendiente de aprobación.")
-        load_tasks_from_db()
-        return True
+        return transaction
     except Exception as e:
         st.error(f"Error al crear solicitud de extensión: {e}")
-        return False
+        return None
 
 def update_extension_request_status(request_id, new_status, approved_by):
     """Actualiza el estado de una solicitud de extensión"""
     try:
-        sheet = get_gsheet_connection()
-        ws = sheet.worksheet("time_extension_requests")
-        df = get_as_dataframe(ws)
-        df = df[df.iloc[:, 0].notna()].copy() if not df.empty else pd.DataFrame()
-
-        if df.empty:
-            st.error("No hay solicitudes de extensión")
+        # Leer solo la fila de la solicitud
+        solicitud = get_storage().get_record("time_extension_requests", request_id)
+        if solicitud is None:
+            st.error(f"Solicitud con ID {request_id} no encontrada")
             return False
 
-        if 'id' in df.columns:
-            df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(-1).astype(int)
-
-        mask = df["id"] == request_id
-        if mask.any():
-            df.loc[mask, "status"] = new_status
-            df.loc[mask, "approved_by"] = approved_by
-            df.loc[mask, "decision_date"] = date.today().strftime("%Y-%m-%d")
+        with board_transaction():
+            update_record_cells("time_extension_requests", request_id, {
+                "status": new_status,
+                "approved_by": approved_by,
+                "decision_date": date.today().strftime("%Y-%m-%d"),
+            })
 
             # Si la solicitud es aprobada, actualizar la fecha de vencimiento de la tarea
             if new_status == "Aprobada":
-                task_id = int(df.loc[mask, "task_id"].iloc[0])
-                requested_due_date = df.loc[mask, "requested_due_date"].iloc[0]
-
-                # Actualizar fecha de vencimiento en tasks
-                ws_tasks = sheet.worksheet("tasks")
-                df_tasks = get_as_dataframe(ws_tasks)
-                df_tasks = df_tasks[df_tasks.iloc[:, 0].notna()].copy()
-                if 'id' in df_tasks.columns:
-                    df_tasks['id'] = pd.to_numeric(df_tasks['id'], errors='coerce').fillna(-1).astype(int)
-                    task_mask = df_tasks["id"] == task_id
-                    if task_mask.any():
-                        df_tasks.loc[task_mask, "due_date"] = requested_due_date
-                        set_with_dataframe(ws_tasks, df_tasks)
-
-                        # Registrar interacción
-                        add_task_interaction(task_id, approved_by, "extension_approved",
-                                            comment_text=f"Extensión de tiempo aprobada. Nueva fecha de vencimiento: {requested_due_date}")
-
-            set_with_dataframe(ws, df)
-            load_tasks_from_db()
-            return True
-        else:
-            st.error(f"Solicitud con ID {request_id} no encontrada")
-            return False
+                task_id = _as_record_id(solicitud["task_id"])
+                requested_due_date = solicitud["requested_due_date"]
+                if task_id is not None and update_record_cells("tasks", task_id, {"due_date": requested_due_date}):
+                    # Registrar interacción
+                    add_task_interaction(task_id, approved_by, "extension_approved",
+                                        comment_text=f"Extensión de tiempo aprobada. Nueva fecha de vencimiento: {requested_due_date}")
+
+        return True
     except Exception as e:
         st.error(f"Error al actualizar solicitud: {e}")
         return False
@@ -433,13 +2011,8 @@ def update_extension_request_status(request_id, new_status, approved_by):
 # Funciones para items
 # -------------------------
 def add_items_to_task(task_id, items):
-    sheet = get_gsheet_connection()
-    ws_items = sheet.worksheet("task_items")
-    df_items = get_as_dataframe(ws_items)
-    df_items = df_items[df_items.iloc[:, 0].notna()].copy() if not df_items.empty else pd.DataFrame(columns=['id','task_id','item_name','status','progress','completion_date'])
-    new_id = 1 if df_items.empty else int(pd.to_numeric(df_items["id"], errors='coerce').max() + 1)
     new_items = []
-    for item in items:
+    for new_id, item in zip(allocate_ids("task_items", len(items)), items):
         new_items.append({
             "id": new_id,
             "task_id": task_id,
@@ -448,159 +2021,429 @@ def add_items_to_task(task_id, items):
             "progress": 0,
             "completion_date": None
         })
-        new_id += 1
-    df_new_items = pd.DataFrame(new_items)
-    df_items = pd.concat([df_items, df_new_items], ignore_index=True)
-    set_with_dataframe(ws_items, df_items)
+    append_records("task_items", new_items)
     st.success(f"✅ {len(new_items)} items agregados a la tarea {task_id}.")
     load_tasks_from_db()
 
 def update_item_progress_in_db(item_id, new_status, progress, completion_date=None):
-    sheet = get_gsheet_connection()
-    ws_items = sheet.worksheet("task_items")
-    df_items = get_as_dataframe(ws_items)
-    df_items = df_items[df_items.iloc[:, 0].notna()].copy() if not df_items.empty else pd.DataFrame()
-    if df_items.empty:
-        return
-    if 'id' in df_items.columns:
-        df_items['id'] = pd.to_numeric(df_items['id'], errors='coerce').fillna(-1).astype(int)
-    mask = df_items["id"] == item_id
+    changes = {}
     if new_status:
-        df_items.loc[mask, "status"] = new_status
+        changes["status"] = new_status
     if progress is not None:
-        df_items.loc[mask, "progress"] = progress
+        changes["progress"] = progress
     if completion_date:
-        df_items.loc[mask, "completion_date"] = completion_date
-    set_with_dataframe(ws_items, df_items)
+        changes["completion_date"] = completion_date
+    update_record_cells("task_items", item_id, changes)
+
+def find_task(task_id):
+    """Tarea del snapshot vigente por id (None si no existe)"""
+    snapshot = current_board()
+    for tasks in snapshot.kanban.values():
+        for task in tasks:
+            if task.id == int(task_id):
+                return task
+    return None
 
 def recalc_task_progress(task_id):
-    ws_items = get_gsheet_connection().worksheet("task_items")
-    df_items = get_as_dataframe(ws_items)
-    df_items = df_items[df_items.iloc[:, 0].notna()].copy() if not df_items.empty else pd.DataFrame()
-    if df_items.empty:
-        return
-    df_items['task_id'] = pd.to_numeric(df_items['task_id'], errors='coerce').fillna(-1).astype(int)
-    task_items = df_items[df_items['task_id'] == task_id]
-    if not task_items.empty:
-        avg_progress = task_items['progress'].mean()
-        update_task_status_in_db(task_id, None, progress=int(avg_progress))
+    """Promedia el avance de los items de la tarea (snapshot + cambios pendientes) sin releer task_items"""
+    task = find_task(task_id)
+    progress = [item.progress for item in task.items] if task else []
+    transaction = _active_transaction.get()
+    if transaction is not None and task:
+        for pos, item in enumerate(task.items):
+            progress[pos] = transaction.pending_changes("task_items", item.id).get('progress', item.progress)
+    if transaction is not None:
+        progress.extend(r.get('progress') for r in transaction.pending_records("task_items")
+                        if _as_record_id(r.get('task_id')) == int(task_id))
+    if progress:
+        progress = pd.to_numeric(pd.Series(progress), errors='coerce').fillna(0)
+        update_task_status_in_db(task_id, None, progress=int(progress.mean()))
 
 # -------------------------
 # Procesamiento de imágenes
 # -------------------------
-def process_image(uploaded_file, max_size=(800,600)):
+def _encode_image(image, quality):
+    buffer = BytesIO()
+    if features.check("webp"):
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+        return buffer.getvalue(), "image/webp"
+    image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue(), "image/jpeg"
+
+def render_image_variants(data, full_size=IMAGE_FULL_SIZE):
     """
-    Procesa y redimensiona una imagen para que se guarde en base64.
-    Devuelve string base64 o None en error.
+    Versión completa (máx. full_size) y miniatura de una imagen, en WebP (o JPEG progresivo),
+    con la orientación EXIF aplicada y sin metadatos. Rechaza imágenes demasiado grandes antes de decodificarlas.
+    """
+    image = Image.open(BytesIO(data))  # solo lee el encabezado
+    if image.width * image.height > IMAGE_MAX_PIXELS:
+        raise ValueError(f"La imagen es demasiado grande ({image.width}x{image.height})")
+    # en JPEG decodifica directamente a escala reducida (mucho más rápido con fotos de 12+ MP)
+    image.draft("RGB", full_size)
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    full = image.copy()
+    full.thumbnail(full_size, Image.Resampling.LANCZOS)
+    thumb = full.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    return _encode_image(full, IMAGE_QUALITY), _encode_image(thumb, 70)
+
+def process_image(uploaded_file, full_size=IMAGE_FULL_SIZE):
+    """
+    Procesa la imagen (decodificación reducida con draft, así que es rápido incluso con fotos grandes).
+    Devuelve ((bytes, mime) completa, (bytes, mime) miniatura) o None en error.
     """
     try:
-        image = Image.open(uploaded_file)
-        if image.mode in ('RGBA', 'P'):
-            image = image.convert('RGB')
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        buffer = BytesIO()
-        image.save(buffer, format="JPEG", quality=85)
-        img_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return img_str
+        size = getattr(uploaded_file, "size", None)
+        if size is not None and size > IMAGE_MAX_UPLOAD_BYTES:
+            st.error(f"La imagen supera el límite de {IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+            return None
+        data = uploaded_file.getvalue() if hasattr(uploaded_file, "getvalue") else uploaded_file.read()
+        return render_image_variants(data, full_size)
     except Exception as e:
         st.error(f"Error al procesar la imagen: {e}")
         return None
 
+def save_evidence_image(uploaded_file):
+    """
+    Procesa la imagen y devuelve las columnas de la interacción: {image_ref, thumbnail_ref} con un almacén
+    de blobs configurado, o {image_base64} si se guarda dentro de la hoja. None en error.
+    """
+    inline = blob_store_backend() == "inline"
+    variants = process_image(uploaded_file, INLINE_IMAGE_SIZE if inline else IMAGE_FULL_SIZE)
+    if not variants:
+        return None
+    (full, full_mime), (thumb, thumb_mime) = variants
+    if inline:
+        return {"image_base64": base64.b64encode(full).decode("ascii")}
+    try:
+        store = get_blob_store()
+        return {"image_ref": store.put(full, full_mime), "thumbnail_ref": store.put(thumb, thumb_mime)}
+    except Exception as e:
+        st.error(f"Error al guardar la imagen: {e}")
+        return None
+
+# -------------------------
+# Almacén de blobs (imágenes de evidencia)
+# -------------------------
+BLOB_REF_PREFIX = "sha256:"
+
+def blob_ref_for(data):
+    """Referencia por contenido: la misma imagen siempre produce la misma referencia"""
+    return BLOB_REF_PREFIX + hashlib.sha256(data).hexdigest()
+
+def _blob_digest(ref):
+    digest = str(ref)[len(BLOB_REF_PREFIX):] if str(ref).startswith(BLOB_REF_PREFIX) else ""
+    if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+        raise ValueError(f"Referencia de imagen inválida: {ref}")
+    return digest
+
+class LocalBlobStore:
+    """Guarda cada blob una sola vez en un directorio local, con su hash SHA-256 como nombre"""
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, ref):
+        digest = _blob_digest(ref)
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data, content_type="application/octet-stream"):
+        ref = blob_ref_for(data)
+        path = self._path(ref)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return ref
+
+    def get(self, ref):
+        with open(self._path(ref), "rb") as f:
+            return f.read()
+
+class DriveBlobStore:
+    """
+    Guarda los blobs en una carpeta de Google Drive (de una unidad compartida) con la misma
+    cuenta de servicio de la hoja. El nombre del archivo es el hash, así que no se duplican.
+    """
+    FILES_URL = "https://www.googleapis.com/drive/v3/files"
+    UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+
+    def __init__(self, http_client, folder_id):
+        if not folder_id:
+            raise ValueError("Falta blob_drive_folder_id para el almacén 'gdrive'")
+        self.http_client = http_client
+        self.folder_id = folder_id
+
+    def _find(self, digest):
+        response = self.http_client.request("get", self.FILES_URL, params={
+            "q": f"name = '{digest}' and '{self.folder_id}' in parents and trashed = false",
+            "fields": "files(id)",
+            "supportsAllDrives": "true",
+            "includeItemsFromAllDrives": "true",
+        })
+        files = response.json().get("files", [])
+        return files[0]["id"] if files else None
+
+    def put(self, data, content_type="application/octet-stream"):
+        ref = blob_ref_for(data)
+        digest = _blob_digest(ref)
+        if self._find(digest):
+            return ref
+        boundary = hashlib.md5(data).hexdigest()
+        metadata = json.dumps({"name": digest, "parents": [self.folder_id]})
+        body = (f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{metadata}\r\n"
+                f"--{boundary}\r\nContent-Type: {content_type}\r\n\r\n").encode() + data + f"\r\n--{boundary}--".encode()
+        self.http_client.request("post", self.UPLOAD_URL,
+                                 params={"uploadType": "multipart", "supportsAllDrives": "true"},
+                                 data=body, headers={"Content-Type": f"multipart/related; boundary={boundary}"})
+        return ref
+
+    def get(self, ref):
+        file_id = self._find(_blob_digest(ref))
+        if not file_id:
+            raise FileNotFoundError(ref)
+        response = self.http_client.request("get", f"{self.FILES_URL}/{file_id}",
+                                            params={"alt": "media", "supportsAllDrives": "true"})
+        return response.content
+
+# Backends disponibles; para agregar otro basta con registrar aquí una función que lo construya
+BLOB_BACKENDS = {
+    "local": lambda: LocalBlobStore(get_setting("blob_dir", BLOB_DIR)),
+    "gdrive": lambda: DriveBlobStore(get_gsheet_connection().client, get_setting("blob_drive_folder_id")),
+}
+
+def blob_store_backend():
+    return str(get_setting("blob_store", "inline")).strip().lower()
+
+@st.cache_resource
+def get_blob_store():
+    backend = blob_store_backend()
+    if backend == "inline":
+        raise ValueError("No hay almacén de evidencias configurado (blob_store) para las imágenes con referencia")
+    if backend not in BLOB_BACKENDS:
+        raise ValueError(f"Almacén de blobs desconocido: {backend}")
+    return BLOB_BACKENDS[backend]()
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_blob(ref):
+    return get_blob_store().get(ref)
+
+def load_evidence_image(interaction):
+    """Bytes de la imagen de una interacción (referencia al almacén o base64 heredado); None si no tiene"""
+    ref = interaction.image_ref
+    if isinstance(ref, str) and ref.strip():
+        return load_blob(ref.strip())
+    legacy = interaction.image_base64
+    if isinstance(legacy, str) and legacy.strip():
+        return base64.b64decode(legacy)
+    return None
+
+def has_evidence_image(interaction):
+    return any(isinstance(value, str) and value.strip() for value in (interaction.image_ref, interaction.image_base64))
+
+def migrate_inline_images_to_blobs(allow_local=False):
+    """
+    Mueve las imágenes base64 de task_interactions al almacén de blobs y deja solo la referencia; devuelve cuántas.
+    Se niega sin almacén configurado y, con el almacén "local", salvo confirmación (allow_local) de que el disco es persistente.
+    """
+    backend = blob_store_backend()
+    if backend == "inline":
+        raise ValueError("No hay almacén de evidencias configurado (blob_store): las imágenes ya se guardan en la hoja")
+    if backend == "local" and not allow_local:
+        raise ValueError("El almacén 'local' no es persistente en todas las instalaciones: confirme antes de migrar")
+    # releer para trabajar con números de fila actuales
+    invalidate_board_snapshot()
+    snapshot = get_board_snapshot(current_snapshot_version())
+    df = snapshot.frames["task_interactions"]
+    if df.empty or 'image_base64' not in df.columns:
+        return 0
+    inline = df['image_base64'].map(lambda v: isinstance(v, str) and bool(v.strip()))
+    store = get_blob_store()
+    changes = {}
+    for row, image_b64 in df.loc[inline, 'image_base64'].items():
+        ref = store.put(base64.b64decode(image_b64), "image/jpeg")
+        changes[row] = {"image_ref": ref, "image_base64": ""}
+    if changes:
+        get_storage().update_rows("task_interactions", changes)
+        invalidate_board_snapshot()
+    return int(inline.sum())
+
+def _row_ranges(rows):
+    """Agrupa números de fila en rangos contiguos (inicio, fin), del último al primero"""
+    ranges = []
+    for row in sorted(rows, reverse=True):
+        if ranges and ranges[-1][0] == row + 1:
+            ranges[-1] = (row, ranges[-1][1])
+        else:
+            ranges.append((row, row))
+    return ranges
+
+def archive_completed_tasks(older_than_days=ARCHIVE_AFTER_DAYS):
+    """
+    Mueve a las hojas archive_* las tareas en "Hecho" completadas hace más de older_than_days días,
+    junto con sus colaboradores, interacciones, items y solicitudes. Devuelve cuántas tareas se archivaron.
+    """
+    if write_behind_enabled():
+        # las filas pendientes en cola deben estar en la hoja antes de moverlas
+        get_write_behind_queue().flush()
+    # releer para trabajar con números de fila actuales
+    invalidate_board_snapshot()
+    frames = get_board_snapshot(current_snapshot_version()).frames
+    df_tasks = frames["tasks"]
+    if df_tasks.empty:
+        return 0
+    cutoff = pd.Timestamp(date.today() - timedelta(days=older_than_days))
+    completed_at = df_tasks['completion_date']
+    old_done = (df_tasks['status'] == 'Hecho') & completed_at.notna() & (completed_at < cutoff)
+    task_ids = set(df_tasks.loc[old_done, 'id'].astype(int).tolist())
+    if not task_ids:
+        return 0
+
+    moved = {}
+    for ws_name in BOARD_WORKSHEETS:
+        df = frames[ws_name]
+        key = 'id' if ws_name == "tasks" else 'task_id'
+        selected = df[df[key].isin(task_ids)]
+        if not selected.empty:
+            moved[ws_name] = selected
+
+    # primero se copia al archivo: si el borrado falla, los datos quedan duplicados pero no se pierden
+    storage = get_storage()
+    storage.write({ARCHIVE_WORKSHEETS[ws_name]: df.to_dict('records') for ws_name, df in moved.items()}, {})
+    storage.delete_rows({ws_name: list(df.index) for ws_name, df in moved.items()})
+
+    # las filas se desplazaron: el snapshot y su índice de filas ya no son válidos
+    registry = _snapshot_registry()
+    with registry["lock"]:
+        registry["version"] += 1
+        registry["archive_version"] += 1
+    return len(task_ids)
+
 # -------------------------
 # Export / limpieza / usuarios
 # -------------------------
-def generate_excel_export():
-    sheet = get_gsheet_connection()
-    output = BytesIO()
+def iter_worksheet_chunks(ws_name, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Recorre la hoja en bloques de chunk_rows filas (una solicitud por bloque); devuelve (encabezado, bloques)"""
+    header = worksheet_columns(ws_name)
+    keep = [i for i, col in enumerate(header) if col not in EXPORT_OMITTED_COLUMNS]
+    return [header[i] for i in keep], get_storage().iter_chunks(ws_name, header, keep, chunk_rows)
+
+def _export_xlsx(path, sheets):
+    import xlsxwriter
+    # constant_memory: cada fila se escribe a disco en cuanto se completa
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_urls": False})
     try:
-        df_tasks = get_as_dataframe(sheet.worksheet("tasks"))
-        df_collab = get_as_dataframe(sheet.worksheet("task_collaborators"))
-        df_inter = get_as_dataframe(sheet.worksheet("task_interactions"))
-        df_items = get_as_dataframe(sheet.worksheet("task_items"))
-        df_extensions = get_as_dataframe(sheet.worksheet("time_extension_requests"))
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            if not df_tasks.empty and df_tasks.iloc[:,0].notna().any():
-                df_tasks.to_excel(writer, sheet_name='Tareas', index=False)
-            else:
-                pd.DataFrame(columns=['id','task','description','date','priority','shift','start_date','due_date','status','completion_date','progress','created_by','document_links']).to_excel(writer, sheet_name='Tareas', index=False)
-            if not df_collab.empty and df_collab.iloc[:,0].notna().any():
-                df_collab.to_excel(writer, sheet_name='Colaboradores', index=False)
-            else:
-                pd.DataFrame(columns=['task_id','username']).to_excel(writer, sheet_name='Colaboradores', index=False)
-            if not df_inter.empty and df_inter.iloc[:,0].notna().any():
-                df_inter.to_excel(writer, sheet_name='Interacciones', index=False)
-            else:
-                pd.DataFrame(columns=['id','task_id','username','action_type','timestamp','comment_text','image_base64','new_status','progress_value']).to_excel(writer, sheet_name='Interacciones', index=False)
-            if not df_items.empty and df_items.iloc[:,0].notna().any():
-                df_items.to_excel(writer, sheet_name='Items', index=False)
-            else:
-                pd.DataFrame(columns=['id','task_id','item_name','status','progress','completion_date']).to_excel(writer, sheet_name='Items', index=False)
-            if not df_extensions.empty and df_extensions.iloc[:,0].notna().any():
-                df_extensions.to_excel(writer, sheet_name='Extensiones', index=False)
-            else:
-                pd.DataFrame(columns=['id','task_id','username','request_date','current_due_date','requested_due_date','reason','status','approved_by','decision_date']).to_excel(writer, sheet_name='Extensiones', index=False)
-        output.seek(0)
-        return output
+        for ws_name, title in sheets:
+            header, chunks = iter_worksheet_chunks(ws_name)
+            worksheet = workbook.add_worksheet(title)
+            worksheet.write_row(0, 0, header)
+            row_number = 1
+            for rows in chunks:
+                for row in rows:
+                    worksheet.write_row(row_number, 0, row)
+                    row_number += 1
+    finally:
+        workbook.close()
+
+def _export_csv(path, sheets):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for ws_name, title in sheets:
+            header, chunks = iter_worksheet_chunks(ws_name)
+            with archive.open(f"{title}.csv", "w") as raw, io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                for rows in chunks:
+                    writer.writerows(rows)
+
+def _export_parquet(path, sheets):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # tipos de Arrow según el esquema de la hoja; texto y categorías se guardan como string
+    arrow_types = {"int": pa.int64(), "float": pa.float64(), "date": pa.date32(), "datetime": pa.timestamp("s")}
+
+    def arrow_array(series, kind):
+        if kind in ("int", "float"):
+            return pa.array(series, type=arrow_types[kind], from_pandas=True)
+        if kind == "date":
+            return pa.array([None if pd.isna(v) else v.date() for v in series], type=arrow_types[kind])
+        if kind == "datetime":
+            return pa.array([None if pd.isna(v) else v.to_pydatetime() for v in series], type=arrow_types[kind])
+        return pa.array([None if pd.isna(v) else str(v) for v in series], type=pa.string())
+
+    with tempfile.TemporaryDirectory() as tmp_dir, zipfile.ZipFile(path, "w") as archive:
+        for ws_name, title in sheets:
+            header, chunks = iter_worksheet_chunks(ws_name)
+            columns = WORKSHEET_SCHEMAS.get(ws_name, {})
+            kinds = [columns[col].kind if col in columns else "text" for col in header]
+            schema = pa.schema([(col, arrow_types.get(kind, pa.string())) for col, kind in zip(header, kinds)])
+            part_path = os.path.join(tmp_dir, f"{title}.parquet")
+            with pq.ParquetWriter(part_path, schema) as writer:
+                for rows in chunks:
+                    df = apply_schema(pd.DataFrame(rows, columns=header), ws_name)
+                    arrays = [arrow_array(df[col], kind) for col, kind in zip(header, kinds)]
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            archive.write(part_path, f"{title}.parquet")
+
+EXPORT_FORMATS = {
+    "xlsx": ("Excel (.xlsx)", _export_xlsx, ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("CSV (.zip)", _export_csv, ".zip", "application/zip"),
+    "parquet": ("Parquet (.zip)", _export_parquet, ".zip", "application/zip"),
+}
+
+def generate_export(fmt="xlsx", include_archived=False):
+    """
+    Exporta las hojas del tablero hoja por hoja y en bloques de EXPORT_CHUNK_ROWS filas a un archivo temporal,
+    sin las columnas de imágenes incrustadas (include_archived agrega las hojas del archivo).
+    Devuelve la ruta del archivo o None en error.
+    """
+    _, writer, suffix, _ = EXPORT_FORMATS[fmt]
+    sheets = list(EXPORT_SHEETS)
+    if include_archived:
+        sheets += [(ARCHIVE_WORKSHEETS[ws_name], f"{title} (archivo)") for ws_name, title in EXPORT_SHEETS]
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix="kanban_export_")
+    os.close(fd)
+    try:
+        writer(path, sheets)
+        return path
     except Exception as e:
+        os.remove(path)
         st.error(f"Error al generar archivo: {e}")
         return None
 
+def generate_excel_export():
+    return generate_export("xlsx")
+
 def clear_task_data_from_db():
     try:
-        sheet = get_gsheet_connection()
-        for ws_name in ["task_collaborators", "task_interactions", "tasks", "task_items", "users", "plant_machines", "time_extension_requests"]:
-            ws = sheet.worksheet(ws_name)
-            ws.clear()
-            # volver a crear encabezados
-            if ws_name == "tasks":
-                ws.update('A1', [['id','task','description','date','priority','shift','start_date','due_date','status','completion_date','progress','created_by','document_links']])
-            elif ws_name == "task_collaborators":
-                ws.update('A1', [['task_id','username']])
-            elif ws_name == "task_interactions":
-                ws.update('A1', [['id','task_id','username','action_type','timestamp','comment_text','image_base64','new_status','progress_value']])
-            elif ws_name == "task_items":
-                ws.update('A1', [['id','task_id','item_name','status','progress','completion_date']])
-            elif ws_name == "users":
-                ws.update('A1', [['username','password_hash','role']])
-            elif ws_name == "plant_machines":
-                ws.update('A1', [['machine_id','machine_name','area','coord_x','coord_y','machine_type','status','last_maintenance','next_maintenance']])
-            elif ws_name == "time_extension_requests":
-                ws.update('A1', [['id','task_id','username','request_date','current_due_date','requested_due_date','reason','status','approved_by','decision_date']])
+        get_storage().clear(["task_collaborators", "task_interactions", "tasks", "task_items", "users", "plant_machines",
+                             "time_extension_requests"] + list(ARCHIVE_WORKSHEETS.values()))
+        bootstrap_schema.clear()
+        _snapshot_registry()["archive_version"] += 1
         st.success("Google Sheet limpiado correctamente.")
     except Exception as e:
         st.error(f"Error al limpiar Google Sheet: {e}")
-    load_tasks_from_db()
+    load_tasks_from_db(force=True)
 
 def create_new_user_in_db(username, password, role):
-    sheet = get_gsheet_connection()
-    ws_users = sheet.worksheet("users")
-    df_users = get_as_dataframe(ws_users)
-    df_users = df_users[df_users.iloc[:,0].notna()].copy() if not df_users.empty else pd.DataFrame(columns=['username','password_hash','role'])
-    if not df_users.empty and username in df_users['username'].values:
+    df_users = read_worksheet("users")
+    if username in df_users['username'].values:
         st.error(f"El usuario '{username}' ya existe.")
         return False
     hashed_password = hash_password(password)
     new_user = {"username": username, "password_hash": hashed_password, "role": role}
-    new_user_df = pd.DataFrame([new_user])
-    if not df_users.empty:
-        for col in df_users.columns:
-            if col not in new_user_df.columns:
-                new_user_df[col] = None
-        new_user_df = new_user_df[df_users.columns]
-    df_users = pd.concat([df_users, new_user_df], ignore_index=True)
-    set_with_dataframe(ws_users, df_users)
+    append_records("users", [new_user])
     st.success(f"Usuario '{username}' creado exitosamente con rol '{role}'.")
     return True
 
 def update_user_password_in_db(username, new_password):
-    sheet = get_gsheet_connection()
-    ws_users = sheet.worksheet("users")
-    df_users = get_as_dataframe(ws_users)
-    df_users = df_users[df_users.iloc[:,0].notna()].copy() if not df_users.empty else pd.DataFrame(columns=['username','password_hash','role'])
+    df_users = read_worksheet("users")
     mask = df_users["username"] == username
     if mask.any():
-        df_users.loc[mask, "password_hash"] = hash_password(new_password)
-        set_with_dataframe(ws_users, df_users)
+        # el índice es el número de fila: solo se reescribe la celda del hash
+        get_storage().update_rows("users", {int(df_users.index[mask][0]): {"password_hash": hash_password(new_password)}})
         st.success(f"Contraseña para '{username}' actualizada exitosamente.")
         return True
     else:
@@ -610,31 +2453,80 @@ def update_user_password_in_db(username, new_password):
 # -------------------------
 # Formateo / display
 # -------------------------
+def formato_fecha(value):
+    """Fecha de un DataFrame tipado como AAAA-MM-DD (vacío si no hay fecha)"""
+    return "" if pd.isna(value) else value.strftime("%Y-%m-%d")
+
+class CardHtmlCache:
+    """LRU acotado de tarjetas HTML compartido por todas las sesiones del proceso"""
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                return html
+        html = render()
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return html
+
+@st.cache_resource
+def get_card_cache():
+    return CardHtmlCache(CARD_CACHE_SIZE)
+
+def _priority_rank(t):
+    return TASK_PRIORITIES.index(t.priority) if t.priority in TASK_PRIORITIES else len(TASK_PRIORITIES)
+
+# Orden de las tarjetas dentro de cada columna (las tareas sin fecha van al final)
+KANBAN_SORTS = {
+    "Vencimiento": lambda t: (t.due_date is None, t.due_date or date.max, _priority_rank(t)),
+    "Prioridad": lambda t: (_priority_rank(t), t.due_date is None, t.due_date or date.max),
+    "Más recientes": lambda t: (-(t.date or date.min).toordinal(), -t.id),
+}
+
+def card_revision(t):
+    """Todo lo que la tarjeta muestra: campos de la tarea, responsables y estados de sus solicitudes de extensión"""
+    return (t.id, t.task, t.description, t.date, t.priority, t.shift, t.start_date, t.due_date, t.status,
+            t.progress, t.created_by, t.document_links, t.responsible_list,
+            tuple(req.status for req in t.extension_requests))
+
 def formatear_tarea_display(t):
-    """Formatea HTML para mostrar tarjeta de tarea (usada en la vista Kanban)"""
+    """Formatea HTML para mostrar tarjeta de tarea (usada en la vista Kanban); la tarjeta se reutiliza mientras no cambie"""
+    # el color depende del día, por eso la fecha forma parte de la clave
+    key = (card_revision(t), date.today())
+    card_html = get_card_cache().get_or_render(key, lambda: render_task_card(t))
+    return {'card_html': card_html, 'interactions': t.interactions,
+            'items': t.items, 'extension_requests': t.extension_requests}
+
+def render_task_card(t):
+    """HTML de la tarjeta de una tarea"""
     card_color = "#393E46"
     try:
-        if t.get('status') == 'Hecho':
+        if t.status == 'Hecho':
             card_color = "#4CAF50"
-        elif t.get('status') in ['Por hacer', 'En proceso']:
-            if t.get('due_date'):
-                try:
-                    task_due_date = date.fromisoformat(str(t['due_date']))
-                    today = date.today()
-                    if task_due_date <= today:
-                        card_color = "#F44336"
-                    elif task_due_date <= today + timedelta(days=3):
-                        card_color = "#FFC107"
-                except Exception:
-                    pass
+        elif t.status in ['Por hacer', 'En proceso']:
+            if t.due_date:
+                today = date.today()
+                if t.due_date <= today:
+                    card_color = "#F44336"
+                elif t.due_date <= today + timedelta(days=3):
+                    card_color = "#FFC107"
     except Exception:
         pass
 
-    description_html = f"<br><strong>📝 Descripción:</strong> {t.get('description','')}" if t.get('description') else ""
-    start_date_html = f"<br><strong>➡️ Inicio:</strong> {t.get('start_date')}" if t.get('start_date') else ""
-    due_date_html = f"<br><strong>🔚 Término:</strong> {t.get('due_date')}" if t.get('due_date') else ""
-    responsible_display = ", ".join(t.get('responsible_list', [])) or "Sin asignar"
-    progress_val = int(t.get('progress', 0) or 0)
+    description_html = f"<br><strong>📝 Descripción:</strong> {t.description}" if t.description else ""
+    start_date_html = f"<br><strong>➡️ Inicio:</strong> {t.start_date}" if t.start_date else ""
+    due_date_html = f"<br><strong>🔚 Término:</strong> {t.due_date}" if t.due_date else ""
+    responsible_display = t.responsible or "Sin asignar"
+    progress_val = t.progress
     progress_html = f"""
     <div style="width: 100%; background-color: #ddd; border-radius: 5px; margin-top: 8px; overflow: hidden;">
         <div style="width: {progress_val}%; background-color: #007bff; color: white; text-align: center; border-radius: 5px; padding: 2px 0;">
@@ -642,12 +2534,12 @@ def formatear_tarea_display(t):
         </div>
     </div>
     """
-    created_by_html = f"<br><strong>👤 Creado por:</strong> {t.get('created_by', 'N/A')}" if t.get('created_by') else "<br><strong>👤 Creado por:</strong> N/A"
+    created_by_html = f"<br><strong>👤 Creado por:</strong> {t.created_by}" if t.created_by else "<br><strong>👤 Creado por:</strong> N/A"
 
     # AÑADIDO: Mostrar enlaces a documentos
     document_links_html = ""
     try:
-        document_links_value = t.get('document_links', '')
+        document_links_value = t.document_links
         if document_links_value and isinstance(document_links_value, str) and document_links_value.strip():
             links = [link.strip() for link in document_links_value.split('\n') if link.strip()]
             valid_links = []
@@ -665,17 +2557,17 @@ def formatear_tarea_display(t):
         document_links_html = ""
 
     # AÑADIDO: Mostrar contador de solicitudes de extensión
-    extension_count = t.get('extension_count', 0)
+    extension_count = t.extension_count
     extension_html = ""
     if extension_count > 0:
         extension_color = "#FF9800" if extension_count == 1 else "#F44336" if extension_count > 1 else "#4CAF50"
         extension_html = f'<br><strong>⏱️ Solicitudes de extensión:</strong> <span style="background-color: {extension_color}; color: white; padding: 2px 8px; border-radius: 10px; font-weight: bold;">{extension_count}</span>'
         if extension_count > 0:
             # Mostrar estado de las solicitudes
-            extension_requests = t.get('extension_requests', [])
-            pending_count = sum(1 for req in extension_requests if req.get('status') == 'Pendiente')
-            approved_count = sum(1 for req in extension_requests if req.get('status') == 'Aprobada')
-            rejected_count = sum(1 for req in extension_requests if req.get('status') == 'Rechazada')
+            status_counts = Counter(req.status for req in t.extension_requests)
+            pending_count = status_counts['Pendiente']
+            approved_count = status_counts['Aprobada']
+            rejected_count = status_counts['Rechazada']
 
             if pending_count > 0:
                 extension_html += f' <span style="background-color: #FFC107; color: black; padding: 2px 6px; border-radius: 10px; font-size: 0.8em;">{pending_count} pendiente(s)</span>'
@@ -686,22 +2578,238 @@ def formatear_tarea_display(t):
 
     card_html = f"""
     <div style="background-color:{card_color}; color:white; padding: 10px; border-radius: 8px; margin-bottom: 10px;">
-        <strong>🔧 Tarea:</strong> {t.get('task','Sin nombre')}
+        <strong>🔧 Tarea:</strong> {t.task or 'Sin nombre'}
         {description_html}
         <br><strong>👷 Responsables:</strong> {responsible_display}
         {created_by_html}
-        <br><strong>📅 Creada:</strong> {t.get('date','')}
+        <br><strong>📅 Creada:</strong> {t.date or ''}
         {start_date_html}
         {due_date_html}
         {extension_html}  <!-- AÑADIDO: Contador de extensiones -->
-        <br><strong>🧭 Turno:</strong> {t.get('shift','')}
-        <br><strong>🔥 Prioridad:</strong> {t.get('priority','')}
+        <br><strong>🧭 Turno:</strong> {t.shift or ''}
+        <br><strong>🔥 Prioridad:</strong> {t.priority or ''}
         {document_links_html}
         {progress_html}
     </div>
     """
-    return {'card_html': card_html, 'interactions': t.get('interactions', []),
-            'items': t.get('items', []), 'extension_requests': t.get('extension_requests', [])}
+    return card_html
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def load_thumbnail(ref):
+    """Miniatura JPEG de un blob, generada una vez y cacheada"""
+    return _thumbnail_bytes(load_blob(ref))
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def _legacy_thumbnail(interaction_id, _image_b64):
+    return _thumbnail_bytes(base64.b64decode(_image_b64))
+
+def _thumbnail_bytes(data):
+    image = Image.open(BytesIO(data))
+    if image.mode in ('RGBA', 'P'):
+        image = image.convert('RGB')
+    image.thumbnail(THUMBNAIL_SIZE)
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=70)
+    return buffer.getvalue()
+
+def evidence_thumbnail(interaction):
+    thumb_ref = interaction.thumbnail_ref
+    if isinstance(thumb_ref, str) and thumb_ref.strip():
+        return load_blob(thumb_ref.strip())
+    ref = interaction.image_ref
+    if isinstance(ref, str) and ref.strip():
+        return load_thumbnail(ref.strip())
+    return _legacy_thumbnail(interaction.id, interaction.image_base64)
+
+def render_interaction_history(task_id, interactions):
+    """
+    Historial de la tarea. Solo se dibuja cuando el usuario lo abre, muestra las HISTORY_PAGE_SIZE
+    entradas más recientes con "Cargar más", y cada evidencia como miniatura; la imagen completa
+    se carga solo si se pide.
+    """
+    if not st.toggle(f"📝 Historial ({len(interactions)})", key=f"history_open_{task_id}"):
+        return
+    limit_key = f"history_limit_{task_id}"
+    limit = st.session_state.get(limit_key, HISTORY_PAGE_SIZE)
+    # las interacciones se agregan en orden cronológico: las últimas son las más recientes
+    recientes = interactions[-limit:][::-1]
+    with st.container(border=True):
+        for pos, interaccion in enumerate(recientes):
+            comment = interaccion.comment_text
+            if isinstance(comment, str) and comment.strip():
+                st.caption(f"💬 {interaccion.username or 'Usuario'} - {interaccion.timestamp or 'Fecha'}")
+                st.info(comment)
+            if has_evidence_image(interaccion):
+                st.caption("📸 Evidencia adjunta")
+                try:
+                    st.image(evidence_thumbnail(interaccion), width=THUMBNAIL_SIZE[0])
+                    if st.toggle("Ver imagen completa", key=f"full_image_{task_id}_{interaccion.id or pos}"):
+                        st.image(load_evidence_image(interaccion), use_container_width=True, caption="Evidencia visual")
+                except Exception as e:
+                    st.error(f"Error al cargar imagen: {e}")
+            st.markdown("---")
+        restantes = len(interactions) - limit
+        if restantes > 0:
+            if st.button(f"Cargar más ({restantes} restantes)", key=f"history_more_{task_id}"):
+                st.session_state[limit_key] = limit + HISTORY_PAGE_SIZE
+                st.rerun(scope="fragment")
+
+def remember_card_patch(task, transaction):
+    """Guarda la tarjeta con el cambio recién enviado para mostrarla sin recargar el tablero"""
+    st.session_state.setdefault('card_patches', {})[task.id] = (current_snapshot_version(), patch_task(task, transaction))
+
+def card_task(task):
+    """Tarea a mostrar en la tarjeta: la versión parcheada si el tablero no cambió desde el envío, si no la vigente"""
+    patch = st.session_state.get('card_patches', {}).get(task.id)
+    if patch is None:
+        return task
+    version, patched = patch
+    if version == current_snapshot_version():
+        return patched
+    return find_task(task.id) or task
+
+@st.fragment
+def render_kanban_card(task, estado, is_admin):
+    """
+    Tarjeta con sus formularios. Cada envío vuelve a ejecutar solo este fragmento y muestra la tarjeta
+    con el cambio aplicado localmente; el resto del tablero se actualiza en la siguiente ejecución completa.
+    """
+    task = card_task(task)
+    task_display = formatear_tarea_display(task)
+    st.markdown(task_display['card_html'], unsafe_allow_html=True)
+
+    # Mostrar items dentro de la tarjeta (compacto); vienen agrupados por tarea desde el snapshot
+    if task_display['items']:
+        with st.expander("📌 Items", expanded=False):
+            for item in task_display['items']:
+                st.write(f"**{item.item_name}** - {item.progress}% [{item.status}]")
+                current_username = st.session_state.get('username')
+                if is_admin or (current_username and current_username in task.responsible_list):
+                    with st.form(key=f"form_item_{item.id}", clear_on_submit=False):
+                        new_prog = st.slider("Avance", 0, 100, item.progress, 5, key=f"slider_item_{item.id}")
+                        comment = st.text_input("Comentario (opcional)", key=f"comment_item_{item.id}")
+                        evidencia = st.file_uploader("Evidencia (imagen) - opcional", type=['png','jpg','jpeg'], key=f"evidence_item_{item.id}")
+                        submit_item = st.form_submit_button("Actualizar Item")
+                        if submit_item:
+                            imagen = {}
+                            if evidencia:
+                                imagen = save_evidence_image(evidencia)
+                                if not imagen:
+                                    st.error("Error procesando la imagen.")
+                                    st.stop()
+                            new_status = "Hecho" if new_prog==100 else ("En proceso" if new_prog>0 else "Por hacer")
+                            with board_transaction(reload=False) as transaction:
+                                update_item_progress_in_db(item.id, new_status, int(new_prog),
+                                                            date.today().strftime("%Y-%m-%d") if new_prog==100 else None)
+                                add_task_interaction(task.id, st.session_state.username, "item_update", comment_text=comment, progress_value=int(new_prog), **imagen)
+                                recalc_task_progress(task.id)
+                            remember_card_patch(task, transaction)
+                            st.rerun(scope="fragment")
+
+    # Opción para solicitar extensión de tiempo
+    if estado in ['Por hacer','En proceso'] and task.due_date:
+        current_username = st.session_state.get('username')
+        if current_username and current_username in task.responsible_list:
+            with st.expander("⏱️ Solicitar extensión de tiempo", expanded=False):
+                with st.form(key=f"extension_form_{task.id}"):
+                    st.write(f"Fecha de vencimiento actual: **{task.due_date}**")
+                    current_due_date = task.due_date
+                    requested_due_date = st.date_input(
+                        "Nueva fecha de vencimiento solicitada",
+                        min_value=date.today(),
+                        key=f"requested_date_{task.id}"
+                    )
+                    reason = st.text_area(
+                        "Razón de la extensión (requerido)",
+                        placeholder="Explica por qué necesitas más tiempo...",
+                        key=f"reason_{task.id}"
+                    )
+                    submit_extension = st.form_submit_button("Enviar solicitud")
+                    if submit_extension:
+                        if not reason.strip():
+                            st.error("Debes proporcionar una razón para la extensión")
+                        elif requested_due_date <= current_due_date:
+                            st.error("La nueva fecha debe ser posterior a la fecha actual de vencimiento")
+                        else:
+                            # la función abre y envía su propia transacción: el error de escritura se informa ahí
+                            transaction = request_time_extension(
+                                task_id=task.id,
+                                username=current_username,
+                                current_due_date=current_due_date.strftime("%Y-%m-%d"),
+                                requested_due_date=requested_due_date.strftime("%Y-%m-%d"),
+                                reason=reason,
+                                reload=False
+                            )
+                            if transaction is not None:
+                                remember_card_patch(task, transaction)
+                                st.rerun(scope="fragment")
+
+    # historial de interacciones
+    if task_display['interactions']:
+        render_interaction_history(task.id, task_display['interactions'])
+
+    # acciones para responsables/admin
+    if estado in ['Por hacer','En proceso']:
+        current_username = st.session_state.get('username')
+        if is_admin or (current_username and current_username in task.responsible_list):
+            with st.expander(f"✏️ Actualizar {task.task}", expanded=False):
+                with st.form(key=f"update_task_form_{task.id}"):
+                    progreso_actual = task.progress
+                    nuevo_progreso = st.slider("Porcentaje de avance:", 0, 100, progreso_actual, 5, key=f"progress_{task.id}_form")
+                    comentario = st.text_area("Comentario:", key=f"comment_{task.id}_form")
+                    evidencia = st.file_uploader("Subir evidencia (imagen):", type=["png","jpg","jpeg"], key=f"upload_{task.id}_form")
+                    col1_form, col2_form = st.columns(2)
+                    with col1_form:
+                        submit_avance = st.form_submit_button("Guardar avance")
+                    with col2_form:
+                        submit_completar = st.form_submit_button("Marcar como completada")
+                    if submit_avance or submit_completar:
+                        imagen = {}
+                        if evidencia:
+                            imagen = save_evidence_image(evidencia)
+                            if not imagen:
+                                st.error("Error al procesar la imagen.")
+                                st.stop()
+                        if submit_completar:
+                            nuevo_estado = "Hecho"
+                            nuevo_progreso = 100
+                            fecha_completado = date.today().strftime("%Y-%m-%d")
+                        else:
+                            nuevo_estado = task.status
+                            fecha_completado = None
+                        with board_transaction(reload=submit_completar) as transaction:
+                            update_task_status_in_db(task.id, nuevo_estado, fecha_completado, progress=int(nuevo_progreso))
+                            add_task_interaction(task.id, st.session_state.username, 'status_change' if submit_completar else 'progress_update', comment_text=comentario, new_status=nuevo_estado, progress_value=int(nuevo_progreso), **imagen)
+                        if submit_completar:
+                            # la tarjeta cambia de columna: se vuelve a dibujar todo el tablero
+                            st.rerun()
+                        remember_card_patch(task, transaction)
+                        st.rerun(scope="fragment")
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def task_summary_frame(board_key, _kanban):
+    """Tabla del "Resumen General de Tareas", calculada una vez por versión del tablero"""
+    todas_las_tareas = []
+    for estado, lista_tareas in _kanban.items():
+        for t in lista_tareas:
+            todas_las_tareas.append({
+                "ID": t.id,
+                "Tarea": t.task,
+                "Estado": t.status,
+                "Progreso (%)": t.progress,
+                "Responsables": t.responsible,
+                "Fecha Vencimiento": t.due_date,
+                "Fecha Completado": t.completion_date or 'Pendiente'
+            })
+    return pd.DataFrame(todas_las_tareas)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def task_summary_excel(board_key, _df_resumen):
+    """Excel del resumen; se genera solo cuando se pide y se reutiliza mientras el tablero no cambie"""
+    buffer = BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        _df_resumen.to_excel(writer, index=False, sheet_name='Tareas')
+    return buffer.getvalue()
 
 # -------------------------
 # Interfaz (login + app)
@@ -715,10 +2823,25 @@ def initialize_app():
         st.session_state.current_role = None
     if 'form_cleared' not in st.session_state:
         st.session_state.form_cleared = False
-    # asegurar hojas
-    ensure_worksheets_exist()
-    if 'kanban' not in st.session_state:
-        load_tasks_from_db()
+    # asegurar hojas (una sola vez por versión de esquema y proceso)
+    try:
+        bootstrap_schema(SCHEMA_VERSION)
+    except Exception as e:
+        st.error(f"Error al verificar hojas: {str(e)}")
+    # primera vez con SQLite: se copian los datos de Google Sheets a la base local vacía
+    if storage_backend() == "sqlite":
+        imported, error = seed_local_storage(SCHEMA_VERSION)
+        if error and not st.session_state.get('seed_warned'):
+            st.warning(f"No se pudieron importar los datos de Google Sheets a la base local: {error}")
+            st.session_state.seed_warned = True
+    # en modo write-behind el hilo de envío arranca con la app (y reenvía lo que haya quedado en cola)
+    if write_behind_enabled():
+        get_write_behind_queue()
+    # en modo offline-first el tablero se lee de la réplica; el hilo de sincronización se conecta cuando pueda
+    if storage_backend() == "offline":
+        connect_offline_sync()
+    # el snapshot es compartido y cacheado: solo se vuelve a leer Sheets si cambió la versión o venció el TTL
+    load_tasks_from_db()
 
 def login_screen():
     st.set_page_config(page_title="Login - Collaborative Management System", layout="centered")
@@ -733,6 +2856,28 @@ def login_screen():
     with st.container():
         col1, col2, col3 = st.columns([1,3,1])
         with col2:
+            if first_admin_setup_allowed():
+                # base SQLite nueva sin datos importados: nadie podría ingresar sin un primer administrador
+                with st.form("first_admin_form"):
+                    st.subheader("Crear administrador inicial")
+                    st.caption("No hay usuarios registrados. El usuario creado aquí tendrá el rol Admin Principal.")
+                    admin_username = st.text_input("Usuario")
+                    admin_password = st.text_input("Contraseña", type="password")
+                    admin_confirm = st.text_input("Confirmar contraseña", type="password")
+                    setup_token = st.text_input("Clave de configuración (admin_setup_token)", type="password")
+                    if st.form_submit_button("Crear administrador"):
+                        if not valid_admin_setup_token(setup_token):
+                            st.error("Clave de configuración incorrecta")
+                        elif not admin_username.strip() or not admin_password:
+                            st.error("Usuario y contraseña son requeridos")
+                        elif admin_password != admin_confirm:
+                            st.error("Las contraseñas no coinciden")
+                        elif not first_admin_setup_allowed():
+                            st.error("Ya existe un usuario registrado; ingrese con sus credenciales.")
+                        elif create_new_user_in_db(admin_username.strip(), admin_password, "Admin Principal"):
+                            st.rerun()
+                st.caption("**Engineered by Erik Armenta, M.Eng.** | _Operational Excellence through Technology_")
+                return
             with st.form("main_login_form"):
                 st.subheader("Acceso al Sistema")
                 username = st.text_input("Usuario")
@@ -750,8 +2895,34 @@ def main_app():
         if st.session_state.logged_in:
             st.write(f"👤 Usuario: **{st.session_state.username}**")
             st.write(f"🎚️ Rol: **{st.session_state.current_role}**")
+            if storage_backend() == "sheets":
+                st.caption(f"📡 Solicitudes a Google Sheets (último minuto): {sheets_requests_last_minute()}")
+            else:
+                st.caption("💾 Datos en base local (SQLite)")
+            if storage_backend() == "offline":
+                sync = get_offline_sync()
+                if sync.last_sync:
+                    st.caption(f"🔁 Última sincronización con Google Sheets: {sync.last_sync:%H:%M:%S}")
+                pendientes = sync.pending_count()
+                if pendientes:
+                    st.caption(f"⏳ {pendientes} cambio(s) pendiente(s) de sincronizar con Google Sheets")
+                if sync.last_error:
+                    st.warning(f"Sin conexión con Google Sheets: {sync.last_error}")
+                conflictos = sync.conflicts()
+                if conflictos:
+                    with st.expander(f"⚠️ {len(conflictos)} cambio(s) en conflicto no enviados"):
+                        st.caption("La fila fue modificada en Google Sheets por otro usuario; se conservó esa versión.")
+                        for creado, hoja, clave, cambios in conflictos:
+                            st.write(f"{creado} · {hoja} {clave or ''}: {cambios}")
+            if write_behind_enabled():
+                queue = get_write_behind_queue()
+                pendientes = queue.pending_count()
+                if pendientes:
+                    st.caption(f"⏳ {pendientes} cambio(s) pendiente(s) de sincronizar con Google Sheets")
+                if queue.last_error:
+                    st.warning(f"Sincronización en espera: {queue.last_error}")
             if st.button("🔄 Refrescar Tablero", use_container_width=True):
-                load_tasks_from_db()
+                load_tasks_from_db(force=True)
                 st.success("Tablero actualizado")
             if st.button("Cerrar Sesión", use_container_width=True):
                 st.session_state.logged_in = False
@@ -776,11 +2947,9 @@ def main_app():
         with tabs[tab_names.index("➕ Agregar Tarea")]:
             st.header("➕ Agregar Nueva Tarea")
             st.markdown("---")
-            sheet = get_gsheet_connection()
-            df_users = get_as_dataframe(sheet.worksheet("users"))
-            df_users = df_users[df_users.iloc[:,0].notna()].copy() if not df_users.empty else pd.DataFrame()
+            df_users = read_worksheet("users")
             collab_users = []
-            if not df_users.empty and 'role' in df_users.columns:
+            if not df_users.empty:
                 collab_users = df_users[df_users['role'].str.lower().isin(["colaborador","coordinador","supervisor"])]['username'].tolist()
             with st.form("agregar_tarea", clear_on_submit=True):
                 tarea = st.text_input("Nombre de la Tarea*", value="")
@@ -795,8 +2964,8 @@ def main_app():
                 fecha = st.date_input("Fecha de Creación*", date.today())
                 fecha_inicial = st.date_input("Fecha Inicial (Opcional)", value=None)
                 fecha_termino = st.date_input("Fecha Término (Opcional)", value=None)
-                prioridad = st.selectbox("Prioridad*", ["Alta","Media","Baja"])
-                turno = st.selectbox("Turno*", ["1er Turno","2do Turno","3er Turno"])
+                prioridad = st.selectbox("Prioridad*", list(TASK_PRIORITIES))
+                turno = st.selectbox("Turno*", list(TASK_SHIFTS))
                 destino = st.selectbox("Columna Inicial*", ["Por hacer","En proceso"])
                 submit = st.form_submit_button("Crear Tarea")
                 if submit:
@@ -815,13 +2984,12 @@ def main_app():
                             "due_date": fecha_termino.strftime("%Y-%m-%d") if fecha_termino else None,
                             "document_links": document_links if document_links and document_links.strip() else ""
                         }
-                        add_task_to_db(nueva_tarea, destino, responsables)
-                        # agregar items si los hay
-                        if items_raw.strip():
-                            items = [i.strip() for i in items_raw.splitlines() if i.strip()]
-                            # obtener last id
-                            last_id = int(st.session_state.all_tasks_df["id"].max())
-                            add_items_to_task(last_id, items)
+                        with board_transaction():
+                            new_task_id = add_task_to_db(nueva_tarea, destino, responsables)
+                            # agregar items si los hay
+                            if items_raw.strip():
+                                items = [i.strip() for i in items_raw.splitlines() if i.strip()]
+                                add_items_to_task(new_task_id, items)
                         st.session_state.form_cleared = True
                         st.rerun()
 
@@ -831,40 +2999,23 @@ def main_app():
 
         # --- NUEVO: RESUMEN DE TAREAS ---
         with st.expander("📊 Resumen General de Tareas", expanded=False):
-            # Consolidar todas las tareas del diccionario kanban en una lista plana
-            todas_las_tareas = []
-            for estado, lista_tareas in st.session_state.kanban.items():
-                for t in lista_tareas:
-                    # Limpiamos un poco el diccionario para el DataFrame
-                    tarea_limpia = {
-                        "ID": t.get('id'),
-                        "Tarea": t.get('task'),
-                        "Estado": t.get('status'),
-                        "Progreso (%)": t.get('progress'),
-                        "Responsables": ", ".join(t.get('responsible_list', [])),
-                        "Fecha Vencimiento": t.get('due_date'),
-                        "Fecha Completado": t.get('completed_date', 'Pendiente')
-                    }
-                    todas_las_tareas.append(tarea_limpia)
-
-            if todas_las_tareas:
-                df_resumen = pd.DataFrame(todas_las_tareas)
+            board_key = st.session_state.get('board_key')
+            df_resumen = task_summary_frame(board_key, st.session_state.kanban)
 
+            if not df_resumen.empty:
                 # Mostrar el DataFrame
                 st.dataframe(df_resumen, use_container_width=True)
 
-                # Botón para descargar Excel
-                import io
-                buffer = io.BytesIO()
-                with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                    df_resumen.to_excel(writer, index=False, sheet_name='Tareas')
-
-                st.download_button(
-                    label="📥 Descargar Resumen en Excel",
-                    data=buffer.getvalue(),
-                    file_name=f"resumen_tareas_{date.today()}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+                # El Excel se arma solo cuando se pide (y queda cacheado para esta versión del tablero)
+                if st.button("📄 Preparar Resumen en Excel", key="prepare_summary_excel"):
+                    st.session_state.summary_excel_key = board_key
+                if st.session_state.get('summary_excel_key') == board_key:
+                    st.download_button(
+                        label="📥 Descargar Resumen en Excel",
+                        data=task_summary_excel(board_key, df_resumen),
+                        file_name=f"resumen_tareas_{date.today()}.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    )
             else:
                 st.info("No hay tareas registradas para mostrar en el resumen.")
         # --- FIN NUEVO BLOQUE ---
@@ -872,169 +3023,71 @@ def main_app():
         st.markdown("---")
         # refrescar manual
         if st.button("🔄 Refrescar Tablero", key="refresh_kanban_top"):
-            load_tasks_from_db()
+            load_tasks_from_db(force=True)
             st.success("Tablero actualizado")
         # filtro por responsable
         all_responsibles = []
         for status_list in st.session_state.kanban.values():
             for task in status_list:
-                if 'responsible_list' in task:
-                    all_responsibles.extend(task['responsible_list'])
+                all_responsibles.extend(task.responsible_list)
         responsables_unicos = sorted(list(set(all_responsibles)))
         default_idx = 0
         if (st.session_state.current_role or "").lower() == "colaborador" and st.session_state.username in responsables_unicos:
             default_idx = responsables_unicos.index(st.session_state.username) + 1
-        filtro_responsable = st.selectbox("👤 Filtrar por responsable:", ["(Todos)"] + responsables_unicos, index=default_idx)
+        col_filtro, col_orden, col_pagina = st.columns([2, 1, 1])
+        with col_filtro:
+            filtro_responsable = st.selectbox("👤 Filtrar por responsable:", ["(Todos)"] + responsables_unicos, index=default_idx)
+        # orden y tamaño de página propios de cada usuario (se guardan en su sesión)
+        with col_orden:
+            orden = st.selectbox("↕️ Ordenar por:", list(KANBAN_SORTS), index=list(KANBAN_SORTS).index(KANBAN_DEFAULT_SORT),
+                                 key=f"kanban_sort_{st.session_state.username}")
+        with col_pagina:
+            por_pagina = st.selectbox("Tarjetas por columna:", KANBAN_PAGE_SIZES, key=f"kanban_page_size_{st.session_state.username}")
         # columnas kanban
         cols = st.columns(3)
-        estados = ["Por hacer","En proceso","Hecho"]
-        # cargar items global
-        try:
-            df_items_global = get_as_dataframe(get_gsheet_connection().worksheet("task_items"))
-            df_items_global = df_items_global[df_items_global.iloc[:,0].notna()].copy() if not df_items_global.empty else pd.DataFrame()
-        except Exception:
-            df_items_global = pd.DataFrame()
+        estados = list(TASK_STATUSES)
 
         for col, estado in zip(cols, estados):
             with col:
                 st.markdown(f"### {estado}")
                 tareas_estado = st.session_state.kanban.get(estado, [])
-                tareas_mostrar = [t for t in tareas_estado if filtro_responsable == "(Todos)" or filtro_responsable in t.get('responsible_list',[])]
+                tareas_mostrar = [t for t in tareas_estado if filtro_responsable == "(Todos)" or filtro_responsable in t.responsible_list]
                 if not tareas_mostrar:
                     st.info("No hay tareas en esta sección.")
                     continue
-                for task in tareas_mostrar:
-                    task_display = formatear_tarea_display(task)
-                    st.markdown(task_display['card_html'], unsafe_allow_html=True)
-
-                    # Mostrar items dentro de la tarjeta (compacto)
-                    items_task = []
-                    if not df_items_global.empty and 'task_id' in df_items_global.columns:
-                        df_items_global['task_id'] = pd.to_numeric(df_items_global['task_id'], errors='coerce').fillna(-1).astype(int)
-                        items_task = df_items_global[df_items_global['task_id']==int(task['id'])].to_dict('records')
-
-                    if items_task:
-                        with st.expander("📌 Items", expanded=False):
-                            for item in items_task:
-                                st.write(f"**{item.get('item_name')}** - {int(item.get('progress',0))}% [{item.get('status')}]")
-                                current_username = st.session_state.get('username')
-                                if is_admin or (current_username and current_username in task.get('responsible_list',[])):
-                                    with st.form(key=f"form_item_{item['id']}", clear_on_submit=False):
-                                        new_prog = st.slider("Avance", 0, 100, int(item.get('progress',0)), 5, key=f"slider_item_{item['id']}")
-                                        comment = st.text_input("Comentario (opcional)", key=f"comment_item_{item['id']}")
-                                        evidencia = st.file_uploader("Evidencia (imagen) - opcional", type=['png','jpg','jpeg'], key=f"evidence_item_{item['id']}")
-                                        submit_item = st.form_submit_button("Actualizar Item")
-                                        if submit_item:
-                                            imagen_b64 = None
-                                            if evidencia:
-                                                imagen_b64 = process_image(evidencia)
-                                                if not imagen_b64:
-                                                    st.error("Error procesando la imagen.")
-                                                    st.stop()
-                                            new_status = "Hecho" if new_prog==100 else ("En proceso" if new_prog>0 else "Por hacer")
-                                            update_item_progress_in_db(int(item['id']), new_status, int(new_prog),
-                                                                        date.today().strftime("%Y-%m-%d") if new_prog==100 else None)
-                                            add_task_interaction(int(task['id']), st.session_state.username, "item_update", comment_text=comment, image_base64=imagen_b64, progress_value=int(new_prog))
-                                            recalc_task_progress(int(task['id']))
-                                            st.rerun()
-
-                    # Opción para solicitar extensión de tiempo
-                    if estado in ['Por hacer','En proceso'] and task.get('due_date'):
-                        current_username = st.session_state.get('username')
-                        if current_username and current_username in task.get('responsible_list',[]):
-                            with st.expander("⏱️ Solicitar extensión de tiempo", expanded=False):
-                                with st.form(key=f"extension_form_{task['id']}"):
-                                    st.write(f"Fecha de vencimiento actual: **{task.get('due_date')}**")
-                                    current_due_date = task.get('due_date')
-                                    requested_due_date = st.date_input(
-                                        "Nueva fecha de vencimiento solicitada",
-                                        min_value=date.today(),
-                                        key=f"requested_date_{task['id']}"
-                                    )
-                                    reason = st.text_area(
-                                        "Razón de la extensión (requerido)",
-                                        placeholder="Explica por qué necesitas más tiempo...",
-                                        key=f"reason_{task['id']}"
-                                    )
-                                    submit_extension = st.form_submit_button("Enviar solicitud")
-                                    if submit_extension:
-                                        if not reason.strip():
-                                            st.error("Debes proporcionar una razón para la extensión")
-                                        elif requested_due_date <= date.fromisoformat(current_due_date):
-                                            st.error("La nueva fecha debe ser posterior a la fecha actual de vencimiento")
-                                        else:
-                                            if request_time_extension(
-                                                task_id=int(task['id']),
-                                                username=current_username,
-                                                current_due_date=current_due_date,
-                                                requested_due_date=requested_due_date.strftime("%Y-%m-%d"),
-                                                reason=reason
-                                            ):
-                                                st.rerun()
-
-                    # historial de interacciones
-                    if task_display['interactions']:
-                        with st.expander(f"📝 Historial ({len(task_display['interactions'])})", expanded=False):
-                            for interaccion in task_display['interactions']:
-                                if interaccion.get('comment_text'):
-                                    st.caption(f"💬 {interaccion.get('username','Usuario')} - {interaccion.get('timestamp','Fecha')}")
-                                    st.info(interaccion['comment_text'])
-                                if interaccion.get('image_base64'):
-                                    st.caption("📸 Evidencia adjunta")
-                                    try:
-                                        img_data = base64.b64decode(interaccion['image_base64'])
-                                        st.image(img_data, use_container_width=True, caption="Evidencia visual")
-                                    except Exception as e:
-                                        st.error(f"Error al cargar imagen: {e}")
-                                st.markdown("---")
-
-                    # acciones para responsables/admin
-                    if estado in ['Por hacer','En proceso']:
-                        current_username = st.session_state.get('username')
-                        if is_admin or (current_username and current_username in task.get('responsible_list',[])):
-                            with st.expander(f"✏️ Actualizar {task.get('task')}", expanded=False):
-                                with st.form(key=f"update_task_form_{task['id']}"):
-                                    progreso_actual = int(task.get('progress',0) or 0)
-                                    nuevo_progreso = st.slider("Porcentaje de avance:", 0, 100, progreso_actual, 5, key=f"progress_{task['id']}_form")
-                                    comentario = st.text_area("Comentario:", key=f"comment_{task['id']}_form")
-                                    evidencia = st.file_uploader("Subir evidencia (imagen):", type=["png","jpg","jpeg"], key=f"upload_{task['id']}_form")
-                                    col1_form, col2_form = st.columns(2)
-                                    with col1_form:
-                                        submit_avance = st.form_submit_button("Guardar avance")
-                                    with col2_form:
-                                        submit_completar = st.form_submit_button("Marcar como completada")
-                                    if submit_avance or submit_completar:
-                                        imagen_b64 = None
-                                        if evidencia:
-                                            imagen_b64 = process_image(evidencia)
-                                            if not imagen_b64:
-                                                st.error("Error al procesar la imagen.")
-                                                st.stop()
-                                        if submit_completar:
-                                            nuevo_estado = "Hecho"
-                                            nuevo_progreso = 100
-                                            fecha_completado = date.today().strftime("%Y-%m-%d")
-                                        else:
-                                            nuevo_estado = task.get('status')
-                                            fecha_completado = None
-                                        update_task_status_in_db(int(task['id']), nuevo_estado, fecha_completado, progress=int(nuevo_progreso))
-                                        add_task_interaction(int(task['id']), st.session_state.username, 'status_change' if submit_completar else 'progress_update', comment_text=comentario, image_base64=imagen_b64, new_status=nuevo_estado, progress_value=int(nuevo_progreso))
-                                        st.rerun()
+                # solo se dibujan las primeras tarjetas; el resto se carga con "Mostrar más"
+                limit_key = f"kanban_limit_{estado}"
+                limite = max(st.session_state.get(limit_key, por_pagina), por_pagina)
+                tareas_ordenadas = sorted(tareas_mostrar, key=KANBAN_SORTS[orden])
+                st.caption(f"{min(limite, len(tareas_ordenadas))} de {len(tareas_ordenadas)} tareas")
+                for task in tareas_ordenadas[:limite]:
+                    render_kanban_card(task, estado, is_admin)
+
+                restantes = len(tareas_ordenadas) - limite
+                if restantes > 0:
+                    if st.button(f"Mostrar más ({restantes} restantes)", key=f"kanban_more_{estado}"):
+                        st.session_state[limit_key] = limite + por_pagina
+                        st.rerun()
 
     # --- Pestaña: Estadísticas (Solo admin) ---
     if is_admin and "📊 Estadísticas" in tab_names:
         with tabs[tab_names.index("📊 Estadísticas")]:
             st.header("📊 Estadísticas del Kanban")
+            incluir_archivo = st.checkbox("Incluir tareas archivadas", key="stats_include_archive")
             st.markdown("---")
 
-            if st.session_state.all_tasks_df.empty:
+            stats_tasks_df = st.session_state.all_tasks_df
+            if incluir_archivo:
+                try:
+                    _, stats_tasks_df = load_task_history()
+                except Exception as e:
+                    st.warning(f"No se pudo leer el archivo de tareas: {e}")
+
+            if stats_tasks_df.empty:
                 st.info("No hay datos de tareas para mostrar estadísticas.")
             else:
-                df = st.session_state.all_tasks_df.copy()
-
-                df['due_date'] = pd.to_datetime(df['due_date'], errors='coerce')
-                df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce')
-                df['date'] = pd.to_datetime(df['date'], errors='coerce')
+                # el DataFrame ya viene tipado (fechas datetime64, estado/prioridad categóricos) y no se modifica
+                df = stats_tasks_df
 
                 # Métricas clave
                 st.subheader("Métricas Clave")
@@ -1051,11 +3104,8 @@ def main_app():
                                      (df['due_date'].dt.date <= hoy + timedelta(days=3)) &
                                      (df['status'] != 'Hecho')])
 
-                # Calcular solicitudes de extensión
-                sheet = get_gsheet_connection()
-                ws_extensions = sheet.worksheet("time_extension_requests")
-                df_extensions = get_as_dataframe(ws_extensions)
-                df_extensions = df_extensions[df_extensions.iloc[:, 0].notna()].copy() if not df_extensions.empty else pd.DataFrame()
+                # Calcular solicitudes de extensión (ya vienen en el snapshot del tablero)
+                df_extensions = current_board().frames["time_extension_requests"]
 
                 total_extensiones = len(df_extensions) if not df_extensions.empty else 0
                 extensiones_pendientes = len(df_extensions[df_extensions['status'] == 'Pendiente']) if not df_extensions.empty else 0
@@ -1150,11 +3200,11 @@ def main_app():
 
                 # Avance por responsable
                 st.subheader("Avance por Responsable")
-                df_filtered_responsibles = df[df['responsible_list'].apply(lambda x: isinstance(x, list) and len(x) > 0)]
+                df_filtered_responsibles = df[df['responsible_list'].map(len) > 0]
 
                 if not df_filtered_responsibles.empty:
                     df_flat = df_filtered_responsibles.explode('responsible_list')
-                    df_responsable = df_flat.groupby(['responsible_list', 'status']).size().unstack(fill_value=0)
+                    df_responsable = df_flat.groupby(['responsible_list', 'status'], observed=True).size().unstack(fill_value=0)
                     df_responsable = df_responsable.reset_index().melt(id_vars='responsible_list',
                                                                         value_name='Cantidad',
                                                                         var_name='Estado')
@@ -1182,7 +3232,7 @@ def main_app():
                 # Distribución por prioridad
                 st.subheader("Distribución de Tareas por Prioridad")
                 if 'priority' in df.columns:
-                    prioridad_counts = df['priority'].value_counts().reset_index()
+                    prioridad_counts = df['priority'].value_counts().loc[lambda counts: counts > 0].reset_index()
                     prioridad_counts.columns = ['Prioridad', 'Cantidad']
 
                     fig_prioridad = px.pie(
@@ -1203,24 +3253,35 @@ def main_app():
                 else:
                     st.warning("No hay datos de prioridad para mostrar.")
 
+            st.markdown("---")
+            st.subheader("📤 Exportar datos")
+            formato = st.selectbox("Formato", list(EXPORT_FORMATS), format_func=lambda f: EXPORT_FORMATS[f][0], key="export_format")
+            exportar_archivo = st.checkbox("Incluir hojas del archivo", key="export_include_archive")
+            if st.button("Generar exportación", key="export_generate"):
+                with st.spinner("Generando exportación..."):
+                    export_path = generate_export(formato, include_archived=exportar_archivo)
+                if export_path:
+                    _, _, suffix, mime = EXPORT_FORMATS[formato]
+                    with open(export_path, "rb") as f:
+                        st.download_button("📥 Descargar exportación", data=f, file_name=f"kanban_{date.today()}{suffix}",
+                                           mime=mime, key="export_download")
+                    os.remove(export_path)
+
     # --- Pestaña: Solicitudes de Extensión (Solo admin) ---
     if is_admin and "⏱️ Solicitudes Extensión" in tab_names:
         with tabs[tab_names.index("⏱️ Solicitudes Extensión")]:
             st.header("⏱️ Solicitudes de Extensión de Tiempo")
             st.markdown("---")
 
-            # Cargar solicitudes
-            sheet = get_gsheet_connection()
-            ws_extensions = sheet.worksheet("time_extension_requests")
-            df_extensions = get_as_dataframe(ws_extensions)
-            df_extensions = df_extensions[df_extensions.iloc[:, 0].notna()].copy() if not df_extensions.empty else pd.DataFrame()
+            # Cargar solicitudes (del snapshot compartido, sin otra lectura a Sheets)
+            df_extensions = current_board().frames["time_extension_requests"]
 
             if df_extensions.empty:
                 st.info("No hay solicitudes de extensión pendientes.")
             else:
                 # Mostrar solicitudes pendientes primero
                 st.subheader("Solicitudes Pendientes")
-                df_pendientes = df_extensions[df_extensions['status'] == 'Pendiente'].copy()
+                df_pendientes = df_extensions[df_extensions['status'] == 'Pendiente']
 
                 if df_pendientes.empty:
                     st.info("No hay solicitudes pendientes.")
@@ -1230,9 +3291,9 @@ def main_app():
                             col1, col2 = st.columns(2)
                             with col1:
                                 st.write(f"**👤 Solicitante:** {solicitud['username']}")
-                                st.write(f"**📅 Fecha solicitud:** {solicitud['request_date']}")
-                                st.write(f"**⏰ Vencimiento actual:** {solicitud['current_due_date']}")
-                                st.write(f"**📅 Vencimiento solicitado:** {solicitud['requested_due_date']}")
+                                st.write(f"**📅 Fecha solicitud:** {formato_fecha(solicitud['request_date'])}")
+                                st.write(f"**⏰ Vencimiento actual:** {formato_fecha(solicitud['current_due_date'])}")
+                                st.write(f"**📅 Vencimiento solicitado:** {formato_fecha(solicitud['requested_due_date'])}")
 
                             with col2:
                                 st.write(f"**📋 Razón:**")
@@ -1257,11 +3318,10 @@ def main_app():
                 st.subheader("Historial de Solicitudes")
 
                 # Filtrar para excluir pendientes
-                df_historial = df_extensions[df_extensions['status'] != 'Pendiente'].copy()
+                df_historial = df_extensions[df_extensions['status'] != 'Pendiente']
 
                 if not df_historial.empty:
                     # Ordenar por fecha de decisión descendente
-                    df_historial['decision_date'] = pd.to_datetime(df_historial['decision_date'], errors='coerce')
                     df_historial = df_historial.sort_values('decision_date', ascending=False)
 
                     for _, solicitud in df_historial.iterrows():
@@ -1271,14 +3331,14 @@ def main_app():
                             col1, col2 = st.columns(2)
                             with col1:
                                 st.write(f"**👤 Solicitante:** {solicitud['username']}")
-                                st.write(f"**📅 Fecha solicitud:** {solicitud['request_date']}")
-                                st.write(f"**⏰ Vencimiento actual:** {solicitud['current_due_date']}")
-                                st.write(f"**📅 Vencimiento solicitado:** {solicitud['requested_due_date']}")
+                                st.write(f"**📅 Fecha solicitud:** {formato_fecha(solicitud['request_date'])}")
+                                st.write(f"**⏰ Vencimiento actual:** {formato_fecha(solicitud['current_due_date'])}")
+                                st.write(f"**📅 Vencimiento solicitado:** {formato_fecha(solicitud['requested_due_date'])}")
                                 st.write(f"**🎚️ Estado:** <span style='color:{status_color}; font-weight:bold;'>{solicitud['status']}</span>", unsafe_allow_html=True)
 
                             with col2:
                                 st.write(f"**👨‍💼 Aprobado por:** {solicitud['approved_by']}")
-                                st.write(f"**📅 Fecha decisión:** {solicitud['decision_date']}")
+                                st.write(f"**📅 Fecha decisión:** {formato_fecha(solicitud['decision_date'])}")
                                 st.write(f"**📋 Razón:**")
                                 st.info(solicitud['reason'])
                 else:
@@ -1312,10 +3372,7 @@ def main_app():
             st.markdown("---")
 
             # Lista de usuarios existentes
-            sheet = get_gsheet_connection()
-            ws_users = sheet.worksheet("users")
-            usuarios = get_as_dataframe(ws_users)
-            usuarios = usuarios[usuarios.iloc[:, 0].notna()].copy() if not usuarios.empty else pd.DataFrame(columns=['username', 'password_hash', 'role'])
+            usuarios = read_worksheet("users")
 
             if 'password_hash' in usuarios.columns:
                 usuarios_display = usuarios[['username', 'role']].copy()
@@ -1370,6 +3427,31 @@ def main_app():
             st.markdown("---")
             st.subheader("Administración de Base de Datos")
 
+            st.caption("Las imágenes antiguas guardadas en base64 dentro de la hoja pueden moverse al almacén de evidencias.")
+            confirmar_local = False
+            if blob_store_backend() == "local":
+                confirmar_local = st.checkbox("El directorio local de evidencias es persistente (no se borra al reiniciar el servidor)",
+                                              key="confirm_local_blobs")
+            if st.button("🖼️ Migrar imágenes al almacén de evidencias"):
+                try:
+                    migradas = migrate_inline_images_to_blobs(allow_local=confirmar_local)
+                    load_tasks_from_db()
+                    st.success(f"{migradas} imagen(es) migradas.")
+                except Exception as e:
+                    st.error(f"Error al migrar imágenes: {e}")
+
+            st.caption("Las tareas terminadas hace tiempo pueden pasar al archivo; siguen disponibles en estadísticas y exportaciones.")
+            dias_archivo = st.number_input("Archivar tareas en 'Hecho' con más de (días)", min_value=1,
+                                           value=ARCHIVE_AFTER_DAYS, step=1, key="archive_days")
+            if st.button("🗄️ Archivar tareas completadas"):
+                try:
+                    with st.spinner("Archivando tareas..."):
+                        archivadas = archive_completed_tasks(int(dias_archivo))
+                    load_tasks_from_db()
+                    st.success(f"{archivadas} tarea(s) archivadas.")
+                except Exception as e:
+                    st.error(f"Error al archivar tareas: {e}")
+
             with st.form("clear_data_form"):
                 st.markdown("---")
                 st.warning("Zona de peligro - Estas acciones no se pueden deshacer")